@@ -1,42 +1,197 @@
-from ast import For
-from asyncio import constants
-from ctypes.wintypes import HPALETTE
-from multiprocessing.sharedctypes import Value
-from operator import mod
-from re import M
-from z3 import *
 from enum import Enum
-from colorama import Fore
-from colorama import Style
 
+import os
+import sys
+import json
 import time
 import random
+import logging
+import contextlib
+import importlib.util
 
 
-def solve(phi):
-    s = Solver()
+# A module that is only loaded when one of its attributes is first used, so
+# that importing this one stays cheap. z3 and the optional dependencies are
+# only needed once something is solved or printed.
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError("No module named "+name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
 
-    s.append(phi)
-    c = s.check()
-    if c == sat:
-        return s.model()
-    elif c == unsat:
-        return unsat
-    else:
-        print("That was too hard a problem for me, maybe I should go to IITB")
+
+z3 = lazy_import("z3")
+
+logger = logging.getLogger("solve")
 
 
+# Returns the result of the check ("sat", "unsat" or "unknown") and the model
+# when it is sat
 def minimize(phi, objective):
-    s = Optimize()
+    s = z3.Optimize()
     s.add(phi)
-    h = s.minimize(objective)
+    s.minimize(objective)
     c = s.check()
-    if c == sat:
-        return s.model()
-    elif c == unsat:
-        print("unsat")
+    if c == z3.sat:
+        return ("sat", s.model())
+    elif c == z3.unsat:
+        return ("unsat", None)
     else:
-        print("That was too hard a problem for me, maybe I should go to IITB")
+        logger.warning("z3 gave up: %s", s.reason_unknown())
+        return ("unknown", None)
+
+
+# The statistics of a z3 Solver as a dict
+def get_statistics(solver):
+    statistics = solver.statistics()
+    return dict((k, statistics.get_key_value(k)) for k in statistics.keys())
+
+
+# Number of variables and clauses of phi once converted to CNF
+def cnf_size(phi):
+    goal = z3.Goal()
+    goal.add(phi)
+    header = z3.Tactic('tseitin-cnf')(goal)[0].dimacs(False).split("\n")[0]
+    fields = header.split()
+    return (int(fields[2]), int(fields[3]))
+
+
+# A CNF over integer literals as in DIMACS: variable v (counted from 1) is the
+# literal v and its negation -v. The clauses are kept in one flat int array,
+# each ended by a 0. names maps the names of the z3 variables to theirs; the
+# variables added by the clausification have names of the form k!n.
+class CnfFormula:
+    def __init__(self):
+        import array
+        self.variables = 0
+        self.count = 0
+        self.names = {}
+        self.clauses = array.array("i")
+
+    # phi clausified by z3's tseitin-cnf tactic, as cnf_size does
+    @staticmethod
+    def from_constraints(phi):
+        goal = z3.Goal()
+        goal.add(phi)
+        return CnfFormula.from_dimacs(
+            z3.Tactic('tseitin-cnf')(goal)[0].dimacs(True))
+
+    # Reads DIMACS with the variable names in "c <variable> <name>" comments,
+    # as written by z3 and by write_dimacs
+    @staticmethod
+    def from_dimacs(text):
+        cnf = CnfFormula()
+        for line in text.split("\n"):
+            if line.startswith("p"):
+                cnf.variables = int(line.split()[2])
+            elif line.startswith("c"):
+                fields = line.split()
+                if len(fields) == 3:
+                    cnf.names[fields[2]] = int(fields[1])
+            elif line.strip() != "":
+                cnf.clauses.extend(int(l) for l in line.split())
+                cnf.count = cnf.count+1
+        return cnf
+
+    def get_clauses(self):
+        clause = []
+        for literal in self.clauses:
+            if literal == 0:
+                yield clause
+                clause = []
+            else:
+                clause.append(literal)
+
+    # The integer literal of a z3 Bool or of its negation
+    def get_literal(self, literal):
+        if z3.is_not(literal):
+            return -self.get_literal(literal.arg(0))
+        return self.names[str(literal)]
+
+    # assumptions are integer literals, written as unit clauses
+    def write_dimacs(self, output, assumptions=[]):
+        output.write("p cnf %d %d\n" %
+                     (self.variables, self.count+len(assumptions)))
+        for (name, variable) in sorted(self.names.items(), key=lambda n: n[1]):
+            output.write("c %d %s\n" % (variable, name))
+        for clause in self.get_clauses():
+            output.write(" ".join(str(l) for l in clause+[0])+"\n")
+        for literal in assumptions:
+            output.write("%d 0\n" % literal)
+
+
+# A satisfying assignment of a CnfFormula, looked up by z3 variable like a z3
+# model. A variable the clauses do not mention is false.
+class CnfModel:
+    def __init__(self, cnf, literals):
+        self.cnf = cnf
+        self.true = set(l for l in literals if l > 0)
+
+    def __getitem__(self, variable):
+        return self.cnf.names.get(str(variable)) in self.true
+
+
+# Solves a CnfFormula with a SAT solver binary that reads DIMACS and answers
+# as in the SAT competitions (exit code 10 and "v" lines when satisfiable, 20
+# when not), like CaDiCaL and Kissat. solve returns (result, CnfModel or None,
+# statistics) with result "sat", "unsat" or "unknown".
+class DimacsSolver:
+    def __init__(self, command):
+        self.command = command
+
+    def solve(self, cnf, assumptions=[]):
+        import shutil
+        import subprocess
+        import tempfile
+        binary = shutil.which(self.command)
+        if binary is None:
+            raise Exception(self.command+" is not installed")
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "problem.cnf")
+            with open(path, "w") as output:
+                cnf.write_dimacs(output, assumptions)
+            process = subprocess.run([binary, path], capture_output=True,
+                                     text=True)
+        if process.returncode == 20:
+            return ("unsat", None, {})
+        if process.returncode != 10:
+            return ("unknown", None, {})
+        literals = []
+        for line in process.stdout.split("\n"):
+            if line.startswith("v"):
+                literals.extend(int(l) for l in line.split()[1:])
+        return ("sat", CnfModel(cnf, literals), {})
+
+
+# Solves a CnfFormula in process with a PySAT solver, CaDiCaL by default
+class PysatSolver:
+    def __init__(self, name="cadical153"):
+        self.name = name
+
+    def solve(self, cnf, assumptions=[]):
+        from pysat.solvers import Solver
+        with Solver(name=self.name, bootstrap_with=cnf.get_clauses()) as solver:
+            sat = solver.solve(assumptions=assumptions)
+            statistics = solver.accum_stats()
+            if sat:
+                return ("sat", CnfModel(cnf, solver.get_model()), statistics)
+        return ("unsat", None, statistics)
+
+
+# The SAT solvers a CubeSolver can hand its CNF to instead of solving the
+# constraints with z3
+SAT_SOLVERS = {
+    "cadical": lambda: DimacsSolver("cadical"),
+    "kissat": lambda: DimacsSolver("kissat"),
+    "pysat": PysatSolver,
+}
 
 
 # Symmetric encoding of a Rubik's cube. Each color is encoded by a BitVector with 3 bits, with binary encoding for each color. The faces are marked by the direction, X,Y,Z (in a right handed coordinate system) and each face is marked by the axis and a positive or negative direction. Each square on a face is marked using which other faces they are connected to. Each face is connected to four other faces. This is encoded in two trinary bits (0 representing the negative side of the axis, 1 non-attachment to the axis, 2-attachment with the positive side.). If we are considering the (X,+) face, the (Y,+) side is on the right and (Z,+) face is on the top. The square connected to (Y,-) and (Z,+) is at position (0,2) on the face. The center square is (1,1). The square connected to only the (Z,+) face is (1,2) [1 because it is not connected to the Y axis and 2 because it is attached to the positive side of Z]. The faces are numberd 0 to 5 in (X,-), (X,+),...,(Z,+).
@@ -81,7 +236,7 @@ class FlattedBooleanArray:
         self.size = size
         self.array = []
         for i in range(0, size):
-            self.array.append(Bool(name+":"+str(i)))
+            self.array.append(z3.Bool(name+":"+str(i)))
 
     def equals(self, other):
         constraints = []
@@ -93,9 +248,9 @@ class FlattedBooleanArray:
                 raise Exception("Size mismatch")
 
             for i in range(0, self.size):
-                constraints.append(Implies(self.array[i], other.array[i]))
-                constraints.append(Implies(other.array[i], self.array[i]))
-        return And(constraints)
+                constraints.append(z3.Implies(self.array[i], other.array[i]))
+                constraints.append(z3.Implies(other.array[i], self.array[i]))
+        return z3.And(constraints)
 
     # exactly one is true
     def get_sanity_constraints(self):
@@ -104,15 +259,15 @@ class FlattedBooleanArray:
         for i in range(0, self.size):
             for j in range(i+1, self.size):
                 constraints.append(
-                    Or(Not(self.array[i]), Not(self.array[j])))
-        constraints.append(Or(self.array))
-        return And(constraints)
+                    z3.Or(z3.Not(self.array[i]), z3.Not(self.array[j])))
+        constraints.append(z3.Or(self.array))
+        return z3.And(constraints)
 
     def __eq__(self, other):
         return self.equals(other)
 
     def __ne__(self, other):
-        return Not(self.equals(other))
+        return z3.Not(self.equals(other))
 
     def get_int_value_from_model(self, model):
         ret = 0
@@ -120,6 +275,36 @@ class FlattedBooleanArray:
             if model[self.array[i]]:
                 return i
 
+    def get_variables(self):
+        return self.array
+
+
+# One-hot move variable whose at-most-one is a sequential counter (Sinz):
+# n-1 extra variables and about 3n clauses instead of n(n-1)/2 pairwise ones.
+class SequentialFlattedBooleanArray(FlattedBooleanArray):
+    def __init__(self, name, size):
+        super().__init__(name, size)
+        self.counter = []
+        for i in range(0, size-1):
+            self.counter.append(z3.Bool(name+":S:"+str(i)))
+
+    # exactly one is true
+    def get_sanity_constraints(self):
+        x = self.array
+        s = self.counter
+        n = self.size
+        constraints = [z3.Or(z3.Not(x[0]), s[0])]
+        for i in range(1, n-1):
+            constraints.append(z3.Or(z3.Not(x[i]), s[i]))
+            constraints.append(z3.Or(z3.Not(s[i-1]), s[i]))
+            constraints.append(z3.Or(z3.Not(x[i]), z3.Not(s[i-1])))
+        constraints.append(z3.Or(z3.Not(x[n-1]), z3.Not(s[n-2])))
+        constraints.append(z3.Or(self.array))
+        return z3.And(constraints)
+
+    def get_variables(self):
+        return self.array+self.counter
+
 
 # An array of Z3 Bools
 
@@ -130,7 +315,7 @@ class BooleanArray:
         self.size = size
         self.array = []
         for i in range(0, size):
-            self.array.append(Bool(name+":"+str(i)))
+            self.array.append(z3.Bool(name+":"+str(i)))
 
     def equals(self, other):
         constraints = []
@@ -143,13 +328,27 @@ class BooleanArray:
                 raise Exception("Size mismatch")
 
             for i in range(0, self.size):
-                constraints.append(Implies(self.array[i], other.array[i]))
-                constraints.append(Implies(other.array[i], self.array[i]))
-        return And(constraints)
+                constraints.append(z3.Implies(self.array[i], other.array[i]))
+                constraints.append(z3.Implies(other.array[i], self.array[i]))
+        return z3.And(constraints)
 
     def __eq__(self, other):
         return self.equals(other)
 
+    # The literals that fix the array to the given int, usable as assumptions.
+    def get_literals(self, value):
+        literals = []
+        for i in range(0, self.size):
+            if value & 1 == 1:
+                literals.append(self.array[i])
+            else:
+                literals.append(z3.Not(self.array[i]))
+            value = value >> 1
+        return literals
+
+    def get_variables(self):
+        return self.array
+
     def get_int_value_from_model(self, model):
         ret = 0
         for i in range(self.size-1, -1, -1):
@@ -160,6 +359,33 @@ class BooleanArray:
         return ret
 
 
+# Move variable in binary (log) encoding: ceil(log2(n)) bits, and the only
+# sanity constraints are the ones ruling out the unused codes.
+class BinaryBooleanArray(BooleanArray):
+    def __init__(self, name, values):
+        bits = 1
+        while (1 << bits) < values:
+            bits = bits+1
+        super().__init__(name, bits)
+        self.values = values
+
+    def get_sanity_constraints(self):
+        constraints = []
+        for value in range(self.values, 1 << self.size):
+            constraints.append(z3.Not(self.equals(value)))
+        return z3.And(constraints)
+
+    def __ne__(self, other):
+        return z3.Not(self.equals(other))
+
+
+MOVE_ENCODINGS = {
+    "onehot": FlattedBooleanArray,
+    "binary": BinaryBooleanArray,
+    "sequential": SequentialFlattedBooleanArray,
+}
+
+
 class FaceState:
     def __init__(self, cube, face):
         lead_str = "C:"+str(cube)+"F:"+str(face) + "S:"
@@ -182,6 +408,11 @@ class CubeState:
         self.array = [FaceState(id, 0), FaceState(id, 1), FaceState(id, 2),
                       FaceState(id, 3), FaceState(id, 4), FaceState(id, 5)]
 
+    # Every bit of the state, in a fixed order
+    def get_variables(self):
+        return [bit for face in self.array for square in face.array
+                for bit in square.array]
+
     @staticmethod
     def is_attached(face, pos, neighbor_face):
         if face//2 == neighbor_face//2:
@@ -222,7 +453,15 @@ class CubeState:
             for index in range(0, 9):
                 constraints.append(
                     self.array[face].array[index] == value_cube.array[face].array[index])
-        return And(constraints)
+        return z3.And(constraints)
+
+    def get_value_literals(self, value_cube):
+        literals = []
+        for face in range(0, 6):
+            for index in range(0, 9):
+                literals.extend(self.array[face].array[index].get_literals(
+                    value_cube.array[face].array[index]))
+        return literals
 
     # Rotates positive face anti clockwise and negative face clockwise
 
@@ -238,7 +477,7 @@ class CubeState:
 
         for i in range(0, 9):
             f_i = rotation_map[i]
-            constraints.append(Implies(move_condition, self.array[face].array[i] ==
+            constraints.append(z3.Implies(move_condition, self.array[face].array[i] ==
                                final_state.array[face].array[f_i]))
             hn_pos = CubeState.get_neighbor_array_pos(
                 face, i, NeighborDirection.HN)
@@ -252,40 +491,75 @@ class CubeState:
             if hn_pos >= 0:
                 nvn_pos = CubeState.get_neighbor_array_pos(
                     face, f_i, NeighborDirection.VN)
-                constraints.append(Implies(move_condition, self.array[face_h_neg].array[hn_pos] ==
+                constraints.append(z3.Implies(move_condition, self.array[face_h_neg].array[hn_pos] ==
                                    final_state.array[face_v_neg].array[nvn_pos]))
             if vn_pos >= 0:
                 nhp_pos = CubeState.get_neighbor_array_pos(
                     face, f_i, NeighborDirection.HP)
-                constraints.append(Implies(move_condition, self.array[face_v_neg].array[vn_pos] ==
+                constraints.append(z3.Implies(move_condition, self.array[face_v_neg].array[vn_pos] ==
                                    final_state.array[face_h_pos].array[nhp_pos]))
             if hp_pos >= 0:
                 nvp_pos = CubeState.get_neighbor_array_pos(
                     face, f_i, NeighborDirection.VP)
-                constraints.append(Implies(move_condition, self.array[face_h_pos].array[hp_pos] ==
+                constraints.append(z3.Implies(move_condition, self.array[face_h_pos].array[hp_pos] ==
                                    final_state.array[face_v_pos].array[nvp_pos]))
 
             if vp_pos >= 0:
                 nhn_pos = CubeState.get_neighbor_array_pos(
                     face, f_i, NeighborDirection.HN)
-                constraints.append(Implies(move_condition, self.array[face_v_pos].array[vp_pos] ==
+                constraints.append(z3.Implies(move_condition, self.array[face_v_pos].array[vp_pos] ==
                                    final_state.array[face_h_neg].array[nhn_pos]))
 
         for f in range(0, 6):
             if f != face:
                 for i in range(0, 9):
                     if not CubeState.is_attached(f, i, face):
-                        constraints.append(Implies(move_condition,
+                        constraints.append(z3.Implies(move_condition,
                                                    self.array[f].array[i] == final_state.array[f].array[i]))
-        return And(constraints)
+        return z3.And(constraints)
 
     def __rotate_nothing(self, move_condition, final_state):
         constraints = []
         for f in range(0, 6):
             for i in range(0, 9):
-                constraints.append(Implies(move_condition,
+                constraints.append(z3.Implies(move_condition,
                                            self.array[f].array[i] == final_state.array[f].array[i]))
-        return And(constraints)
+        return z3.And(constraints)
+
+    # Defines every sticker of final_state once, as a selection between the few
+    # stickers it can come from, keyed by the move. permutations is a list of
+    # (move number, sticker permutation); a sticker that a move leaves in place
+    # falls through to the same sticker of this state.
+    def define_next_state(self, move, final_state, permutations):
+        constraints = []
+        for f in range(0, 6):
+            for i in range(0, 9):
+                position = f*9+i
+                sources = {}
+                for (move_number, permutation) in permutations:
+                    source = permutation[position]
+                    if source != position:
+                        sources.setdefault(source, []).append(move_number)
+                for bit in range(0, 3):
+                    value = self.array[f].array[i].array[bit]
+                    for (source, move_numbers) in sources.items():
+                        condition = z3.Or([move == m for m in move_numbers])
+                        value = z3.If(condition,
+                                   self.array[source//9].array[source % 9].array[bit], value)
+                    constraints.append(
+                        final_state.array[f].array[i].array[bit] == value)
+        return z3.And(constraints)
+
+    # The sticker at every position of final_state is the one this state has
+    # at permutation[position], if move_condition holds
+    def apply_permutation(self, move_condition, final_state, permutation):
+        constraints = []
+        for f in range(0, 6):
+            for i in range(0, 9):
+                source = permutation[f*9+i]
+                constraints.append(z3.Implies(move_condition,
+                                           final_state.array[f].array[i] == self.array[source//9].array[source % 9]))
+        return z3.And(constraints)
 
     def rotate_face(self, move_condition, final_state, face, dir):
         if face == 6:
@@ -296,70 +570,271 @@ class CubeState:
             return final_state.__rotate_face(move_condition, self, face)
 
 
+# The minimal redundant move sequences of up to `length` moves: each one has the
+# same effect as a shorter, or an equally long but lexicographically smaller,
+# sequence turning only layers it turns itself (so forbidding it is safe when
+# some faces are restricted), and none contains a shorter redundant sequence.
+# Sequences are enumerated in (length, lexicographic) order, extending only
+# the sequences that are not redundant.
+def compile_redundant_sequences(moves, length):
+    identity = tuple(range(0, 54))
+    # permutation -> layer sets of the non redundant sequences that give it
+    classes = {identity: [frozenset()]}
+    canonical = set([()])
+    layer = [((), identity)]
+    redundant = []
+    for l in range(1, length+1):
+        next_layer = []
+        for (sequence, permutation) in layer:
+            for move in sorted(moves):
+                extended = sequence + (move,)
+                if extended[1:] not in canonical:
+                    continue
+                composed = tuple(permutation[x]
+                                 for x in MOVE_PERMUTATIONS[move])
+                layers = frozenset([get_move_layer(m) for m in extended])
+                if any(other <= layers for other in classes.get(composed, [])):
+                    redundant.append(extended)
+                    continue
+                classes.setdefault(composed, []).append(layers)
+                canonical.add(extended)
+                next_layer.append((extended, composed))
+        layer = next_layer
+    return redundant
+
+
+REDUNDANT_SEQUENCES = {}
+
+# (kind of state, move choices, transition encoding, move encoding) ->
+# (constraints of a step between two template states, template variables)
+TRANSITION_TEMPLATES = {}
+
+
+def get_redundant_sequences(moves, length):
+    key = (tuple(moves), length)
+    if key not in REDUNDANT_SEQUENCES:
+        REDUNDANT_SEQUENCES[key] = compile_redundant_sequences(moves, length)
+    return REDUNDANT_SEQUENCES[key]
+
+
 class CubePath:
     def __init__(self):
-        self.states = [CubeState(0)]
+        self.states = [self.new_state(0)]
         self.moves = []
         self.constraints = []
         self.restricted = False
+        # When set, the restriction is only enforced under this literal
+        self.restriction_switch = None
+        self.move_set = MOVE_SETS["quarter"]
+        self.macros = []
+        self.padded = False
+        self.move_encoding = "onehot"
+        self.transition_encoding = "implication"
+        self.pruning_level = 1
+        self.pruning_length = 4
 
     def set_init_constraints(self, value_cube):
         self.constraints.append(
             self.states[0].set_value_constraints(value_cube))
 
+    def new_state(self, id):
+        return CubeState(id)
+
+    def get_target_constraint(self, face, index, value, depth=None):
+        if depth is None:
+            depth = len(self.states)-1
+        return self.states[depth].array[face].array[index] == value
+
     def add_target_constraint(self, face, index, value):
-        self.constraints.append(
-            self.states[len(self.states)-1].array[face].array[index] == value)
+        self.constraints.append(self.get_target_constraint(face, index, value))
 
     def set_restricted_movement(self):
         self.restricted = True
 
+    # One of MOVE_SETS, used for the moves added from now on. The move
+    # variables hold the index of a move in the set.
+    def set_move_set(self, move_set):
+        if move_set not in MOVE_SETS:
+            raise Exception("Unknown move set "+move_set)
+        self.move_set = MOVE_SETS[move_set]
+
+    # Lets every move from now on also be a no-op, the value after the moves of
+    # the move set, so that a path of n moves covers all the shorter solutions
+    # too. A no-op is only ever followed by no-ops.
+    def set_padding(self):
+        self.padded = True
+
+    # MacroMoves that the moves added from now on can also be, made of the
+    # moves of the move set, so set it first. A restricted path only uses
+    # those that do not turn the top or bottom face.
+    def set_macros(self, macros):
+        self.macros = [macro.in_move_set(self.move_set) for macro in macros]
+
+    # The move set, the no-op when padded, then the macros
+    def get_move_choices(self):
+        if self.padded:
+            return self.move_set + [12] + self.macros
+        return self.move_set + self.macros
+
+    # One of MOVE_ENCODINGS, used for the moves added from now on
+    def set_move_encoding(self, move_encoding):
+        if move_encoding not in MOVE_ENCODINGS:
+            raise Exception("Unknown move encoding "+move_encoding)
+        self.move_encoding = move_encoding
+
+    # "implication" constrains every sticker under every move with an
+    # Implies(move, ...), "functional" defines every sticker once through
+    # CubeState.define_next_state.
+    def set_transition_encoding(self, transition_encoding):
+        if transition_encoding not in ["implication", "functional"]:
+            raise Exception(
+                "Unknown transition encoding "+transition_encoding)
+        self.transition_encoding = transition_encoding
+
+    def get_transition(self, last_state, move, final_state):
+        moves = self.get_move_choices()
+        if self.transition_encoding == "functional":
+            return last_state.define_next_state(
+                move, final_state, [(i, get_move_permutation(moves[i]))
+                                    for i in range(0, len(moves))])
+        constraints = []
+        for i in range(0, len(moves)):
+            m = moves[i]
+            if not isinstance(m, MacroMove) and m < HALF_TURNS:
+                constraints.append(
+                    last_state.rotate_face(move == i, final_state, m//2, m % 2))
+            else:
+                constraints.append(last_state.apply_permutation(
+                    move == i, final_state, get_move_permutation(m)))
+        return z3.And(constraints)
+
+    # The sanity constraints of the move and get_transition only differ from
+    # step to step in the names of the variables, so they are built once
+    # between two template states and every step gets a copy with its own
+    # variables put in by z3.substitute.
+    def get_step_constraints(self, last_state, move, final_state):
+        moves = self.get_move_choices()
+        key = (type(last_state), tuple(moves), self.transition_encoding,
+               self.move_encoding)
+        if key not in TRANSITION_TEMPLATES:
+            template_last = self.new_state("T")
+            template_final = self.new_state("T'")
+            template_move = MOVE_ENCODINGS[self.move_encoding]("M:T", len(moves))
+            TRANSITION_TEMPLATES[key] = (
+                z3.And(template_move.get_sanity_constraints(),
+                       self.get_transition(template_last, template_move,
+                                           template_final)),
+                template_last.get_variables()+template_final.get_variables() +
+                template_move.get_variables())
+        (template, variables) = TRANSITION_TEMPLATES[key]
+        values = last_state.get_variables()+final_state.get_variables() + \
+            move.get_variables()
+        return z3.substitute(template, list(zip(variables, values)))
+
     def add_rotation(self):
         constraints = []
-        final_state = CubeState(len(self.states))
+        final_state = self.new_state(len(self.states))
         # No-ops move need not be considered since we are going one rotation at a time and the it was unsat with less rotations
-        move = FlattedBooleanArray("M:"+str(len(self.moves)), 12)
-        constraints.append(move.get_sanity_constraints())
+        move = MOVE_ENCODINGS[self.move_encoding](
+            "M:"+str(len(self.moves)), len(self.get_move_choices()))
+        if self.padded and len(self.moves) > 0:
+            noop = len(self.move_set)
+            constraints.append(
+                z3.Implies(self.moves[len(self.moves)-1] == noop, move == noop))
         last_state = self.states[len(self.states)-1]
         self.states.append(final_state)
         self.moves.append(move)
 
-        for i in range(0, 12):
-            face = i//2
-            dir = i % 2
-            if self.restricted and (face == 4 or face == 5):
+        choices = self.get_move_choices()
+        for i in range(0, len(choices)):
+            if isinstance(choices[i], MacroMove):
+                layers = choices[i].layers
+            else:
+                layers = [get_move_layer(choices[i])]
+            if 4 not in layers and 5 not in layers:
+                continue
+            if self.restricted:
                 constraints.append(move != i)
-            constraints.append(
-                last_state.rotate_face(move == i, final_state, face, dir))
-        self.constraints.append(And(constraints))
-
-    def add_helper_constraints(self):
-        # A move and its reversal must not happen consequitively
-        for i in range(1, len(self.moves)):
-            this_move = self.moves[i]
+            elif self.restriction_switch is not None:
+                constraints.append(z3.Implies(self.restriction_switch, move != i))
+        constraints.append(
+            self.get_step_constraints(last_state, move, final_state))
+        self.constraints.append(z3.And(constraints))
+
+    # 0 adds no symmetry breaking, 1 the hand written rules below, 2 also puts
+    # commuting moves on opposite faces in a fixed order and 3 forbids every
+    # redundant sequence of up to `length` moves found by
+    # compile_redundant_sequences instead.
+    def set_pruning_level(self, level, length=4):
+        if level not in [0, 1, 2, 3]:
+            raise Exception("Unknown pruning level "+str(level))
+        self.pruning_level = level
+        self.pruning_length = length
+
+    def add_step_helper_constraints(self, i):
+        if self.pruning_level == 0:
+            return
+        if self.pruning_level == 3:
+            index = dict((m, k) for (k, m) in enumerate(self.move_set))
+            for sequence in get_redundant_sequences(self.move_set, self.pruning_length):
+                if len(sequence) > i+1:
+                    continue
+                start = i+1-len(sequence)
+                self.constraints.append(z3.Not(z3.And(
+                    [self.moves[start+k] == index[sequence[k]] for k in range(0, len(sequence))])))
+            return
+
+        # without half turns the move set is the 12 quarter turns, whose index
+        # is their move number
+        this_move = self.moves[i]
+        half_turns = len(self.move_set) > 12
+        layers = [get_move_layer(m) for m in self.move_set]
+        if i >= 1 and not half_turns:
             prev_move = self.moves[i-1]
+            # A move and its reversal must not happen consequitively
             for j in range(0, 12):
                 opp = j ^ 0x1
                 self.constraints.append(
-                    Implies(this_move == j, prev_move != opp))
+                    z3.Implies(this_move == j, prev_move != opp))
+
+        # with half turns, two consequitive moves of the same layer are one move
+        if i >= 1 and half_turns:
+            prev_move = self.moves[i-1]
+            for j in range(0, len(self.move_set)):
+                for k in range(0, len(self.move_set)):
+                    if layers[k] == layers[j]:
+                        self.constraints.append(
+                            z3.Implies(this_move == j, prev_move != k))
 
         # three consequitive same move cannot happen because that is equivalent to the opposite move once
-        for i in range(2, len(self.moves)):
-            this_move = self.moves[i]
+        if i >= 2 and not half_turns:
             prev_move = self.moves[i-1]
             prev_prev_move = self.moves[i-2]
             for j in range(0, 12):
                 self.constraints.append(
-                    Implies(this_move == j, Implies(prev_move == j, prev_prev_move != j)))
+                    z3.Implies(this_move == j, z3.Implies(prev_move == j, prev_prev_move != j)))
 
         # two consequitve same anti-clockwise moves are disallowed since that is equivalent to two consequitive clockwise moves
-        for i in range(1, len(self.moves)):
-            this_move = self.moves[i]
+        if i >= 1 and not half_turns:
             prev_move = self.moves[i-1]
-            prev_prev_move = self.moves[i-2]
             for j in range(1, 12, 2):
                 self.constraints.append(
-                    Implies(this_move == j, prev_move != j))
+                    z3.Implies(this_move == j, prev_move != j))
+
+        # moves on the layers of one axis commute, so the move on the lower
+        # layer (the negative face, then the positive face, then the slice)
+        # always goes first
+        if i >= 1 and self.pruning_level >= 2:
+            prev_move = self.moves[i-1]
+            for j in range(0, len(self.move_set)):
+                for k in range(0, len(self.move_set)):
+                    if get_layer_axis(layers[k]) == get_layer_axis(layers[j]) and layers[j] < layers[k]:
+                        self.constraints.append(
+                            z3.Implies(this_move == j, prev_move != k))
+
+    def add_helper_constraints(self):
+        for i in range(0, len(self.moves)):
+            self.add_step_helper_constraints(i)
 
     def add_n_rotations(self, n):
         for i in range(0, n):
@@ -367,7 +842,31 @@ class CubePath:
         self.add_helper_constraints()
 
     def get_constraints(self):
-        return And(self.constraints)
+        return z3.And(self.constraints)
+
+    # The number of moves that are not no-ops, on a padded path, a macro
+    # counting as the moves it is made of
+    def get_move_count(self):
+        noop = len(self.move_set)
+        count = [z3.If(move == noop, 0, 1) for move in self.moves]
+        choices = self.get_move_choices()
+        for i in range(0, len(choices)):
+            if isinstance(choices[i], MacroMove):
+                count += [z3.If(move == i, len(choices[i].moves)-1, 0)
+                          for move in self.moves]
+        return z3.Sum(count)
+
+    # The number of moves of the model that are not no-ops
+    def get_step_count(self, model):
+        noop = len(self.move_set)
+        return len([move for move in self.moves
+                    if move.get_int_value_from_model(model) != noop])
+
+    def get_cnf_size(self):
+        return cnf_size(self.get_constraints())
+
+    def get_cnf(self):
+        return CnfFormula.from_constraints(self.get_constraints())
 
     @staticmethod
     def faces_to_relative(front_face, left_face):
@@ -408,18 +907,50 @@ class CubePath:
         relative_move = relative_face + tick
         return relative_move
 
-    def get_relative_moves(self, model, front_face, left_face):
+    def get_move_numbers(self, model, depth=None):
+        if depth is None:
+            depth = len(self.moves)
+        moves = self.get_move_choices()
+        move_numbers = []
+        for move in self.moves[:depth]:
+            choice = moves[move.get_int_value_from_model(model)]
+            if isinstance(choice, MacroMove):
+                move_numbers.extend(choice.moves)
+            else:
+                move_numbers.append(choice)
+        return move_numbers
+
+    # Names the moves as seen from the front and left faces. Half turns get a
+    # 2, and a slice is named M, E or S after the face it turns with (L, D
+    # and F).
+    @staticmethod
+    def get_relative_move_list(move_numbers, front_face, left_face):
         relative_moves = []
         relative_faces = CubePath.faces_to_relative(front_face, left_face)
-        for move in self.moves:
-            move = move.get_int_value_from_model(model)
-            face = move//2
-            dir = move % 2
-            if face == 6:
+        for move in move_numbers:
+            if move == 12 or move == 13:
                 continue
-            relative_dir = dir ^ (0x1 & face)
-            relative_face = relative_faces[face]
-            if relative_dir == 1:
+            if move >= SLICE_TURNS:
+                if move >= SLICE_HALF_TURNS:
+                    axis = move-SLICE_HALF_TURNS
+                else:
+                    axis = (move-SLICE_TURNS)//2
+                face = axis*2
+                relative_face = relative_faces[face]
+                relative_dir = (move-SLICE_TURNS) % 2
+                if relative_face not in ['L', 'D', 'F']:
+                    relative_dir = relative_dir ^ 0x1
+                relative_face = SLICE_NAMES[relative_face]
+            else:
+                if move >= HALF_TURNS:
+                    face = move-HALF_TURNS
+                else:
+                    face = move//2
+                relative_dir = (move % 2) ^ (0x1 & face)
+                relative_face = relative_faces[face]
+            if move >= SLICE_HALF_TURNS or HALF_TURNS <= move < SLICE_TURNS:
+                tick = "2"
+            elif relative_dir == 1:
                 tick = "'"
             else:
                 tick = ""
@@ -427,13 +958,107 @@ class CubePath:
             relative_moves.append(relative_move)
         return relative_moves
 
-    def print_relative_moves(self, model, front_face, left_face):
-        relative_moves = self.get_relative_moves(model, front_face, left_face)
+    # The move numbers of a move string such as "R U2 M' F" (commas work as
+    # separators too), as seen from the front and left faces
+    @staticmethod
+    def parse_move_list(text, front_face, left_face):
+        moves = MOVE_SETS["slice"]
+        names = dict(zip(CubePath.get_relative_move_list(
+            moves, front_face, left_face), moves))
+        move_numbers = []
+        for name in text.replace(",", " ").split():
+            if name not in names:
+                raise Exception("Unknown move "+name)
+            move_numbers.append(names[name])
+        return move_numbers
+
+    @staticmethod
+    def print_move_list(move_numbers, front_face, left_face):
+        relative_moves = CubePath.get_relative_move_list(
+            move_numbers, front_face, left_face)
         print("Front: "+str(front_face)+", Left:"+str(left_face))
         for rm in relative_moves:
             print(rm, end=",")
         print("")
 
+    def get_relative_moves(self, model, front_face, left_face, depth=None):
+        return CubePath.get_relative_move_list(
+            self.get_move_numbers(model, depth), front_face, left_face)
+
+    def print_relative_moves(self, model, front_face, left_face, depth=None):
+        CubePath.print_move_list(
+            self.get_move_numbers(model, depth), front_face, left_face)
+
+
+# A CubePath that stays attached to a single Solver. The path is extended one
+# rotation at a time and the targets are checked against the state at the
+# requested depth under an assumption literal, so the encoding of the shorter
+# paths and everything the solver learned on them is kept for the longer ones.
+class IncrementalCubePath(CubePath):
+    def __init__(self):
+        super().__init__()
+        self.solver = z3.Solver()
+        self.sent = 0
+        self.checks = 0
+
+    def add_rotation(self):
+        super().add_rotation()
+        self.add_step_helper_constraints(len(self.moves)-1)
+
+    def extend_to(self, n):
+        while len(self.moves) < n:
+            self.add_rotation()
+
+    def get_assumptions(self, target_constraints, depth):
+        goal = z3.Bool("G:"+str(self.checks))
+        self.checks = self.checks+1
+        targets = [self.get_target_constraint(c[0], c[1], c[2], depth)
+                   for c in target_constraints]
+        self.solver.add(z3.Implies(goal, z3.And(targets)))
+        return [goal]
+
+    def check_targets(self, target_constraints, depth):
+        self.extend_to(depth)
+        self.solver.add(self.constraints[self.sent:])
+        self.sent = len(self.constraints)
+
+        c = self.solver.check(self.get_assumptions(target_constraints, depth))
+        if c == z3.sat:
+            return self.solver.model()
+        elif c == z3.unsat:
+            return z3.unsat
+        else:
+            logger.warning("z3 gave up: %s", self.solver.reason_unknown())
+
+
+# An IncrementalCubePath whose transition relation is shared by many solves.
+# Nothing about the start state, the targets or the restriction is asserted;
+# they are all passed to the solver as assumption literals, so a path of
+# depth k is encoded only once no matter how many phases or cubes use it.
+# Rotations past the checked depth are always satisfiable and do not matter.
+class SharedCubePath(IncrementalCubePath):
+    def __init__(self):
+        super().__init__()
+        self.restriction_switch = z3.Bool("R")
+        self.init_literals = []
+        self.restricted_literal = z3.Not(self.restriction_switch)
+
+    def select(self, value_cube, restricted):
+        self.init_literals = self.states[0].get_value_literals(value_cube)
+        if restricted:
+            self.restricted_literal = self.restriction_switch
+        else:
+            self.restricted_literal = z3.Not(self.restriction_switch)
+
+    def get_assumptions(self, target_constraints, depth):
+        assumptions = list(self.init_literals)
+        assumptions.append(self.restricted_literal)
+        state = self.states[depth]
+        for c in target_constraints:
+            assumptions.extend(
+                state.array[c[0]].array[c[1]].get_literals(c[2]))
+        return assumptions
+
 
 class ValueCubeFace:
     def __init__(self, id):
@@ -446,12 +1071,13 @@ class ValueCube:
         self.array = [ValueCubeFace(0), ValueCubeFace(
             1), ValueCubeFace(2), ValueCubeFace(3), ValueCubeFace(4), ValueCubeFace(5)]
 
-    def __rotate_face(self, face, dir):
-        if dir == 1:
-            return self.__rotate_face(face, 0).__rotate_face(face, 0).__rotate_face(face, 0)
-
+    # Works out the sticker permutation of a quarter turn of the face (dir 0)
+    # from the neighbour geometry. Stickers are numbered face*9+index and after
+    # the move the sticker at i is the one that was at permutation[i].
+    @staticmethod
+    def compile_rotation(face):
         rotation_map = [2, 5, 8, 1, 4, 7, 0, 3, 6]
-        final_state = ValueCube()
+        permutation = list(range(0, 54))
         negative_face = (face >> 1) << 1
         face_h_neg = (negative_face+2) % 6
         face_h_pos = (negative_face+3) % 6
@@ -461,7 +1087,7 @@ class ValueCube:
         for i in range(0, 9):
 
             f_i = rotation_map[i]
-            final_state.array[face].array[f_i] = self.array[face].array[i]
+            permutation[face*9+f_i] = face*9+i
             hn_pos = CubeState.get_neighbor_array_pos(
                 face, i, NeighborDirection.HN)
             hp_pos = CubeState.get_neighbor_array_pos(
@@ -474,35 +1100,118 @@ class ValueCube:
             if hn_pos >= 0:
                 nvn_pos = CubeState.get_neighbor_array_pos(
                     face, f_i, NeighborDirection.VN)
-                final_state.array[face_v_neg].array[nvn_pos] = self.array[face_h_neg].array[hn_pos]
+                permutation[face_v_neg*9+nvn_pos] = face_h_neg*9+hn_pos
             if vn_pos >= 0:
                 nhp_pos = CubeState.get_neighbor_array_pos(
                     face, f_i, NeighborDirection.HP)
-                final_state.array[face_h_pos].array[nhp_pos] = self.array[face_v_neg].array[vn_pos]
+                permutation[face_h_pos*9+nhp_pos] = face_v_neg*9+vn_pos
             if hp_pos >= 0:
                 nvp_pos = CubeState.get_neighbor_array_pos(
                     face, f_i, NeighborDirection.VP)
-                final_state.array[face_v_pos].array[nvp_pos] = self.array[face_h_pos].array[hp_pos]
+                permutation[face_v_pos*9+nvp_pos] = face_h_pos*9+hp_pos
 
             if vp_pos >= 0:
                 nhn_pos = CubeState.get_neighbor_array_pos(
                     face, f_i, NeighborDirection.HN)
-                final_state.array[face_h_neg].array[nhn_pos] = self.array[face_v_pos].array[vp_pos]
+                permutation[face_h_neg*9+nhn_pos] = face_v_pos*9+vp_pos
+        return permutation
 
+    # The permutation of the middle slice of an axis from the permutation of
+    # the axis' negative face turning the same way: every sticker of a side
+    # face next to that face is carried over to the sticker one row or column
+    # further in, which the slice moves the same way.
+    @staticmethod
+    def compile_slice_rotation(axis, face_permutation):
+        def middle(position):
+            if axis == (position//18+1) % 3:
+                return position+1
+            return position+3
+        permutation = list(range(0, 54))
+        for face in range(0, 6):
+            if face//2 == axis:
+                continue
+            for index in range(0, 9):
+                if CubeState.is_attached(face, index, axis*2):
+                    position = face*9+index
+                    permutation[middle(position)] = middle(
+                        face_permutation[position])
+        return permutation
+
+    # A cube from 54 characters, one per sticker in the order face*9+index.
+    # Any characters can be used for the colours, each face's centre tells
+    # which colour is that face's.
+    @staticmethod
+    def from_facelets(text):
+        if len(text) != 54:
+            raise Exception("A facelet string has 54 characters")
+        faces = dict((text[face*9+4], face) for face in range(0, 6))
+        if len(faces) != 6:
+            raise Exception("The centres do not have 6 different colours")
+        value_cube = ValueCube()
+        for face in range(0, 6):
+            value_cube.array[face].array = [faces[c]
+                                            for c in text[face*9:face*9+9]]
+        value_cube.check_solvable()
+        return value_cube
+
+    # Raises unless the stickers are those of a cube that the moves can solve:
+    # 9 stickers of each colour, every cubie a real one and there once, corner
+    # twists adding up to a multiple of 3, an even number of flipped edges and
+    # corner and edge permutations of the same parity.
+    def check_solvable(self):
+        stickers = self.get_stickers()
+        for color in range(0, 6):
+            if stickers.count(color) != 9:
+                raise Exception("Colour %d is not on 9 stickers" % color)
+        parities = []
+        for (size, name) in [(3, "corner"), (2, "edge")]:
+            slots = [slot for slot in CUBIE_SLOTS if len(slot) == size]
+            homes = [set(p//9 for p in slot) for slot in slots]
+            cubies = []
+            turns = 0
+            for slot in slots:
+                colors = [stickers[p] for p in slot]
+                if set(colors) not in homes:
+                    raise Exception("There is no %s with the colours %s" %
+                                    (name, colors))
+                cubies.append(homes.index(set(colors)))
+                turns = turns+get_reference_index(colors) - \
+                    get_reference_index([p//9 for p in slot])
+            if len(set(cubies)) != len(cubies):
+                raise Exception("A %s is on the cube twice" % name)
+            if turns % size != 0:
+                raise Exception("The %s orientations cannot be solved" % name)
+            inversions = [(i, j) for i in range(0, len(cubies))
+                          for j in range(i+1, len(cubies)) if cubies[i] > cubies[j]]
+            parities.append(len(inversions) % 2)
+        if parities[0] != parities[1]:
+            raise Exception("The corner and edge permutations have different parities")
+
+    def get_stickers(self):
+        stickers = []
+        for face in self.array:
+            stickers.extend(face.array)
+        return stickers
+
+    def apply_permutation(self, permutation):
+        stickers = self.get_stickers()
+        final_state = ValueCube()
         for f in range(0, 6):
-            if f != face:
-                for j in range(0, 9):
-                    if not CubeState.is_attached(f, j, face):
-                        final_state.array[f].array[j] = self.array[f].array[j]
+            final_state.array[f].array = [stickers[p]
+                                          for p in permutation[f*9:f*9+9]]
         return final_state
 
     def rotate_face(self, face, dir):
         if face == 6:
             return self
-        if dir == 0:
-            return self.__rotate_face(face, dir)
-        else:
-            return self.__rotate_face(face, dir)
+        return self.apply_permutation(MOVE_PERMUTATIONS[face*2+dir])
+
+    # Any move number of MOVE_SETS
+    def apply_move(self, move):
+        return self.apply_permutation(MOVE_PERMUTATIONS[move])
+
+    def to_compact(self):
+        return CompactCube(self.get_stickers())
 
     # Print the cube in human readable format.
     # Positions on a negative face -
@@ -564,16 +1273,19 @@ class ValueCube:
 
         return (face, vpos*3+hpos)
 
-    def apply_moves(self, model, moves):
+    # The moves of a model of cube_path, whose move variables index the move
+    # choices of the path
+    def apply_moves(self, model, cube_path, depth=None):
+        return self.apply_move_numbers(cube_path.get_move_numbers(model, depth))
+
+    def apply_move_numbers(self, move_numbers):
         output = self
-        for move in moves:
-            move = move.get_int_value_from_model(model)
-            face = move//2
-            dir = move % 2
-            output = output.rotate_face(face, dir)
+        for move in move_numbers:
+            output = output.apply_move(move)
         return output
 
     def print_index_chart(self):
+        from colorama import Fore
         colors = [Fore.RED, Fore.LIGHTMAGENTA_EX,
                   Fore.GREEN, Fore.BLUE, Fore.WHITE, Fore.YELLOW]
 
@@ -617,243 +1329,2363 @@ class ValueCube:
         self.print_index_chart()
 
 
-# An incremental cube solver
-class CubeSolver:
-    def __init__(self, starting_cube: ValueCube):
-        self.value_cube = starting_cube
-        self.target_constraints = []
-        self.restricted = False
+class CompactCubeFace:
+    __slots__ = ("id", "array")
 
-    def add_target_constraint(self, face, index, value):
-        self.target_constraints.append((face, index, value))
-
-    def set_restricted(self):
-        self.restricted = True
-
-    def solve_minimum(self):
-        max_unsat = 0
-        min_sat = 15
-        try_sat = 0
-        while (True):
-
-            # (max_unsat+min_sat)//2
-            print(try_sat)
-            # print("min_sat:%d, max_unsat: %d" % (min_sat, max_unsat))
-            # if min_sat == max_unsat+1:
-            #     break
-            cube_path = CubePath()
-            if self.restricted:
-                cube_path.set_restricted_movement()
-
-            cube_path.set_init_constraints(self.value_cube)
-
-            cube_path.add_n_rotations(try_sat)
-
-            for c in self.target_constraints:
-                cube_path.add_target_constraint(c[0], c[1], c[2])
-            start_ts = time.time_ns()
-            res = solve(cube_path.get_constraints())
-            end_ts = time.time_ns()
-            diff = end_ts - start_ts
-            print("%s" % (diff/1000000000))
-            if res == unsat:
-                max_unsat = try_sat
-            else:
-                min_sat = try_sat
-                self.model = res
-                self.cube_path = cube_path
-                break
-            try_sat = try_sat+1
+    def __init__(self, id, array):
+        self.id = id
+        self.array = array
 
-        self.value_cube = self.value_cube.apply_moves(
-            self.model, self.cube_path.moves)
 
-        return self.model
+# A ValueCube packed into 54 bytes, one per sticker numbered face*9+index.
+# It is immutable and hashable, so states can be kept in sets and dicts, and
+# it offers the same face/index API as ValueCube (cube.array[face].array[index]).
+class CompactCube:
+    __slots__ = ("stickers",)
 
-    def print_cube(self):
-        self.value_cube.print_cube()
+    def __init__(self, stickers=None):
+        if stickers is None:
+            stickers = [i//9 for i in range(0, 54)]
+        self.stickers = bytes(stickers)
 
-    def print_moves(self, front, left):
-        self.cube_path.print_relative_moves(self.model, front, left)
+    @staticmethod
+    def from_value_cube(value_cube):
+        return CompactCube(value_cube.get_stickers())
 
+    def to_value_cube(self):
+        value_cube = ValueCube()
+        for f in range(0, 6):
+            value_cube.array[f].array = list(self.stickers[f*9:f*9+9])
+        return value_cube
 
-scramble = []
-start_cube = ValueCube()
-for i in range(0, 20):
-    face = int(random.random()*6)
-    dir = int(random.random()*2)
-    if i % 5 == 0:
-        print("")
-        start_cube.print_cube()
-    print(CubePath.get_relative_move(face, dir, 0, 2), end=",")
+    @property
+    def array(self):
+        return [CompactCubeFace(f, self.stickers[f*9:f*9+9]) for f in range(0, 6)]
 
-    start_cube = start_cube.rotate_face(face, dir)
+    def get(self, face, index):
+        return self.stickers[face*9+index]
 
-print("")
-print("Starting solution")
+    def get_stickers(self):
+        return list(self.stickers)
 
-start_cube.print_cube()
+    def apply_permutation(self, permutation):
+        stickers = self.stickers
+        return CompactCube([stickers[p] for p in permutation])
 
-cube_solver = CubeSolver(start_cube)
-cube_solver.add_target_constraint(5, 1, 4)
-cube_solver.add_target_constraint(5, 3, 4)
-cube_solver.add_target_constraint(5, 5, 4)
-cube_solver.add_target_constraint(5, 7, 4)
-cube_solver.add_target_constraint(5, 4, 5)
+    def rotate_face(self, face, dir):
+        if face == 6:
+            return self
+        return self.apply_permutation(MOVE_PERMUTATIONS[face*2+dir])
 
-model = cube_solver.solve_minimum()
+    def apply_move(self, move):
+        return self.apply_permutation(MOVE_PERMUTATIONS[move])
 
-cube_solver.print_moves(0, 2)
-cube_solver.print_cube()
+    def apply_move_numbers(self, move_numbers):
+        output = self
+        for move in move_numbers:
+            output = output.apply_move(move)
+        return output
 
-cube_solver = CubeSolver(cube_solver.value_cube)
-cube_solver.add_target_constraint(4, 1, 4)
-cube_solver.add_target_constraint(4, 3, 4)
-cube_solver.add_target_constraint(4, 5, 4)
-cube_solver.add_target_constraint(4, 7, 4)
-cube_solver.add_target_constraint(0, 1, 0)
-cube_solver.add_target_constraint(1, 1, 1)
-cube_solver.add_target_constraint(2, 3, 2)
-cube_solver.add_target_constraint(3, 3, 3)
+    def print_cube(self):
+        self.to_value_cube().print_cube()
 
-model = cube_solver.solve_minimum()
+    def __eq__(self, other):
+        return isinstance(other, CompactCube) and self.stickers == other.stickers
 
-cube_solver.print_moves(0, 2)
-cube_solver.print_cube()
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.stickers)
+
+    def __repr__(self):
+        return "CompactCube(" + "".join(str(v) for v in self.stickers) + ")"
+
+
+# Move numbers: 0-11 are the quarter turns face*2+dir, 12 and 13 no-ops (face
+# 6), HALF_TURNS+face the half turn of a face, SLICE_TURNS+axis*2+dir the
+# quarter turn of the middle slice of an axis, the same way as the negative
+# face of the axis turns with that dir, and SLICE_HALF_TURNS+axis the half
+# turn of a slice.
+HALF_TURNS = 14
+SLICE_TURNS = 20
+SLICE_HALF_TURNS = 26
+
+MOVE_SETS = {
+    "quarter": list(range(0, 12)),
+    "half": list(range(0, 12))+list(range(HALF_TURNS, SLICE_TURNS)),
+    "slice": list(range(0, 12))+list(range(HALF_TURNS, SLICE_TURNS)) +
+    list(range(SLICE_TURNS, SLICE_HALF_TURNS+3)),
+}
+
+SLICE_NAMES = {'L': 'M', 'R': 'M', 'D': 'E', 'U': 'E', 'F': 'S', 'B': 'S'}
+
+
+# The layer a move turns: its face, or 6+axis for a slice. None for a no-op.
+def get_move_layer(move):
+    if move < 12:
+        return move//2
+    if move < HALF_TURNS:
+        return None
+    if move < SLICE_TURNS:
+        return move-HALF_TURNS
+    if move < SLICE_HALF_TURNS:
+        return 6+(move-SLICE_TURNS)//2
+    return 6+move-SLICE_HALF_TURNS
+
+
+def get_layer_axis(layer):
+    if layer is None:
+        return None
+    if layer < 6:
+        return layer//2
+    return layer-6
+
+
+def get_inverse_move(move):
+    if move < 12 or SLICE_TURNS <= move < SLICE_HALF_TURNS:
+        return move ^ 0x1
+    return move
+
+
+# The sticker permutations of all the moves, indexed by move number. A
+# counter-clockwise turn is the inverse of the clockwise one and a half turn
+# is a quarter turn twice.
+def compile_move_permutations():
+    permutations = []
+    for face in range(0, 6):
+        permutation = ValueCube.compile_rotation(face)
+        inverse = [0]*54
+        for i in range(0, 54):
+            inverse[permutation[i]] = i
+        permutations.append(permutation)
+        permutations.append(inverse)
+    identity = list(range(0, 54))
+    permutations.append(identity)
+    permutations.append(identity)
+    for face in range(0, 6):
+        permutation = permutations[face*2]
+        permutations.append([permutation[x] for x in permutation])
+    for axis in range(0, 3):
+        for dir in range(0, 2):
+            permutations.append(ValueCube.compile_slice_rotation(
+                axis, permutations[axis*4+dir]))
+    for axis in range(0, 3):
+        permutation = permutations[SLICE_TURNS+axis*2]
+        permutations.append([permutation[x] for x in permutation])
+    return permutations
+
+
+MOVE_PERMUTATIONS = compile_move_permutations()
+
+
+# A batch of N cubes held as an (N, 54) uint8 numpy array, one row of
+# stickers (numbered face*9+index) per cube. A move, or a whole move sequence
+# composed into one permutation, is applied to every cube with a single fancy
+# indexing gather. Moves are move numbers (see MOVE_SETS), 12 and 13 being
+# no-ops so that sequences of different lengths can be padded. numpy is only imported
+# when a batch is used.
+class CubeBatch:
+    permutations = None
+
+    def __init__(self, stickers):
+        import numpy as np
+        self.stickers = np.asarray(stickers, dtype=np.uint8).reshape(-1, 54)
 
+    @staticmethod
+    def get_permutations():
+        import numpy as np
+        if CubeBatch.permutations is None:
+            CubeBatch.permutations = np.array(
+                MOVE_PERMUTATIONS, dtype=np.intp)
+        return CubeBatch.permutations
 
-# Half of the white corners.
-cube_solver.add_target_constraint(4, 0, 4)
-cube_solver.add_target_constraint(4, 6, 4)
+    @staticmethod
+    def solved(n):
+        import numpy as np
+        return CubeBatch(np.tile(np.repeat(np.arange(6, dtype=np.uint8), 9), (n, 1)))
 
-cube_solver.add_target_constraint(2, 0, 2)
-cube_solver.add_target_constraint(0, 0, 0)
-cube_solver.add_target_constraint(0, 2, 0)
+    @staticmethod
+    def from_cubes(cubes):
+        return CubeBatch([cube.get_stickers() for cube in cubes])
 
-cube_solver.add_target_constraint(3, 0, 3)
+    def to_cubes(self):
+        return [CompactCube(row.tobytes()) for row in self.stickers]
 
-model = cube_solver.solve_minimum()
+    def __len__(self):
+        return self.stickers.shape[0]
 
-cube_solver.print_moves(0, 2)
-cube_solver.print_cube()
+    # A single permutation equivalent to applying the moves in order
+    @staticmethod
+    def compose(moves):
+        permutations = CubeBatch.get_permutations()
+        composed = permutations[12]
+        for move in moves:
+            composed = composed[permutations[move]]
+        return composed
+
+    def apply_move(self, move):
+        return CubeBatch(self.stickers[:, CubeBatch.get_permutations()[move]])
+
+    def apply_moves(self, moves):
+        return CubeBatch(self.stickers[:, CubeBatch.compose(moves)])
+
+    # Applies a different sequence to every cube: sequences is an (N, L) array
+    # of move numbers, padded with 12 where a sequence is shorter than L.
+    def apply_sequences(self, sequences):
+        import numpy as np
+        sequences = np.asarray(sequences, dtype=np.intp).reshape(len(self), -1)
+        permutations = CubeBatch.get_permutations()
+        composed = np.broadcast_to(permutations[12], self.stickers.shape)
+        for step in range(0, sequences.shape[1]):
+            composed = np.take_along_axis(
+                composed, permutations[sequences[:, step]], axis=1)
+        return CubeBatch(np.take_along_axis(self.stickers, composed, axis=1))
+
+    # Boolean array telling which cubes satisfy all the (face, index, value)
+    # targets, as given to CubeSolver.add_target_constraint
+    def check_targets(self, target_constraints):
+        import numpy as np
+        positions = [c[0]*9+c[1] for c in target_constraints]
+        values = np.array([c[2] for c in target_constraints], dtype=np.uint8)
+        return (self.stickers[:, positions] == values).all(axis=1)
+
+
+# The stickers of every cubie slot, 6 centres, 12 edges and 8 corners, found by
+# grouping the stickers on the set of faces they touch. The stickers of the
+# corners are ordered by carrying the order of the first corner around with the
+# moves, so all corners list their stickers with the same handedness and a
+# move only ever shifts that order cyclically.
+def compile_cubie_slots():
+    slots = {}
+    for face in range(0, 6):
+        for index in range(0, 9):
+            faces = [face]
+            for neighbor_face in range(0, 6):
+                if CubeState.is_attached(face, index, neighbor_face):
+                    faces.append(neighbor_face)
+            slots.setdefault(frozenset(faces), []).append(face*9+index)
+    slots = sorted([tuple(stickers) for stickers in slots.values()])
+
+    ordered = {}
+    corners = [slot for slot in slots if len(slot) == 3]
+    frontier = [corners[0]]
+    ordered[frozenset(corners[0])] = corners[0]
+    while len(frontier) > 0:
+        next_frontier = []
+        for corner in frontier:
+            for move in range(0, 12):
+                destination = MOVE_PERMUTATIONS[move ^ 0x1]
+                moved = tuple(destination[p] for p in corner)
+                if frozenset(moved) not in ordered:
+                    ordered[frozenset(moved)] = moved
+                    next_frontier.append(moved)
+        frontier = next_frontier
+    return [ordered.get(frozenset(slot), slot) for slot in slots]
+
+
+CUBIE_SLOTS = compile_cubie_slots()
+
+
+# For every move and every cubie slot, the slot its cubie comes from and the
+# cyclic shift of the stickers: after the move, sticker k of the slot shows
+# what sticker (k+shift) % n of the source slot showed.
+def compile_cubie_moves():
+    return [compile_cubie_move(permutation) for permutation in MOVE_PERMUTATIONS]
+
+
+def compile_cubie_move(permutation):
+    slot_of = {}
+    for i in range(0, len(CUBIE_SLOTS)):
+        for position in CUBIE_SLOTS[i]:
+            slot_of[position] = i
+    sources = []
+    for slot in CUBIE_SLOTS:
+        source = slot_of[permutation[slot[0]]]
+        shift = CUBIE_SLOTS[source].index(permutation[slot[0]])
+        n = len(slot)
+        for k in range(0, n):
+            if permutation[slot[k]] != CUBIE_SLOTS[source][(k+shift) % n]:
+                raise Exception("Move is not a rotation of the cubies")
+        sources.append((source, shift))
+    return sources
+
+
+CUBIE_MOVES = compile_cubie_moves()
+
+
+# Index, among the faces of the stickers of a cubie (or of their colours), of
+# the one on the top or bottom face, else of the one on face 0 or 1. A move
+# changes the sum of these over the cubies of a kind only by a multiple of
+# the number of stickers of the kind, which makes it an invariant.
+def get_reference_index(faces):
+    for reference in [(4, 5), (0, 1)]:
+        for i in range(0, len(faces)):
+            if faces[i] in reference:
+                return i
 
-# The other half of the white corners.
-cube_solver.add_target_constraint(4, 2, 4)
-cube_solver.add_target_constraint(4, 8, 4)
 
+# A named sequence of moves that a CubePath can make in a single step, through
+# the sticker permutation (and cubie move) of the whole sequence
+class MacroMove:
+    def __init__(self, name, moves):
+        self.name = name
+        self.moves = tuple(moves)
+        permutation = list(range(0, 54))
+        for move in self.moves:
+            permutation = [permutation[p] for p in MOVE_PERMUTATIONS[move]]
+        self.permutation = permutation
+        self.cubie_move = compile_cubie_move(permutation)
+        self.layers = set(get_move_layer(move) for move in self.moves)
+
+    # The same macro in the moves of move_set, a half turn that is not in it
+    # being made twice as a quarter turn
+    def in_move_set(self, move_set):
+        moves = []
+        for move in self.moves:
+            layer = get_move_layer(move)
+            if layer < 6:
+                quarter_turn = layer*2
+            else:
+                quarter_turn = SLICE_TURNS+(layer-6)*2
+            if move in move_set:
+                moves.append(move)
+            elif get_inverse_move(move) == move and quarter_turn in move_set:
+                moves.extend([quarter_turn, quarter_turn])
+            else:
+                raise Exception("Macro "+self.name +
+                                " has a move outside the move set")
+        return MacroMove(self.name, moves)
 
-cube_solver.add_target_constraint(2, 6, 2)
-cube_solver.add_target_constraint(3, 6, 3)
-cube_solver.add_target_constraint(1, 0, 1)
-cube_solver.add_target_constraint(1, 2, 1)
+    def __eq__(self, other):
+        return isinstance(other, MacroMove) and (self.name, self.moves) == (other.name, other.moves)
 
-model = cube_solver.solve_minimum()
+    def __hash__(self):
+        return hash((self.name, self.moves))
 
-cube_solver.print_moves(0, 2)
-cube_solver.print_cube()
 
-# Half of Layer 2
+# The sticker permutation and the cubie move of a move number or a MacroMove
+def get_move_permutation(move):
+    if isinstance(move, MacroMove):
+        return move.permutation
+    return MOVE_PERMUTATIONS[move]
 
-cube_solver.add_target_constraint(0, 3, 0)
-cube_solver.add_target_constraint(0, 5, 0)
-cube_solver.add_target_constraint(2, 1, 2)
-cube_solver.add_target_constraint(3, 1, 3)
 
-model = cube_solver.solve_minimum()
+def get_cubie_move(move):
+    if isinstance(move, MacroMove):
+        return move.cubie_move
+    return CUBIE_MOVES[move]
 
-cube_solver.print_moves(0, 3)
-cube_solver.print_cube()
 
+# Well known last layer sequences, as seen with face 0 in front and face 2 on
+# the left like the scrambles, which puts the last layer (face 5) at D. The A
+# permutations cycle three of its corners without turning it, so restricted
+# phases can use them.
+MACROS = {
+    "A": "L' F L' B2 L F' L' B2 L2",
+    "A'": "L2 B2 L F L' B2 L F' L",
+    "sledgehammer": "L' F L F'",
+    "sexy": "L D L' D'",
+}
 
-# One quarter of layer 2
 
-cube_solver.add_target_constraint(1, 3, 1)
-cube_solver.add_target_constraint(2, 7, 2)
+# MacroMoves from a dict of names and move strings such as MACROS
+def compile_macros(macros):
+    return [MacroMove(name, CubePath.parse_move_list(text, 0, 2))
+            for (name, text) in macros.items()]
 
-model = cube_solver.solve_minimum()
 
-cube_solver.print_moves(0, 3)
-cube_solver.print_cube()
+# State of the cube in terms of cubies. Every movable slot has a binary
+# position variable, which of the cubies of its kind it holds (cubies are
+# numbered by the slot they start in), and a binary orientation: sticker k of
+# the slot shows sticker (k+orientation) % n of the cubie. That is 100 bits per
+# state instead of the 162 of CubeState; centres never move.
+class CubieState:
+    def __init__(self, id):
+        self.id = id
+        self.positions = []
+        self.orientations = []
+        for s in range(0, len(CUBIE_SLOTS)):
+            n = len(CUBIE_SLOTS[s])
+            if n == 1:
+                self.positions.append(None)
+                self.orientations.append(None)
+                continue
+            lead_str = "Q:"+str(id)+"S:"+str(s)
+            self.positions.append(BinaryBooleanArray(
+                lead_str+"P", len(CubieState.slots_of_kind(n))))
+            self.orientations.append(BinaryBooleanArray(lead_str+"O", n))
+
+    # Every bit of the state, in a fixed order
+    def get_variables(self):
+        variables = []
+        for s in range(0, len(CUBIE_SLOTS)):
+            if self.positions[s] is None:
+                continue
+            variables += self.positions[s].array+self.orientations[s].array
+        return variables
 
-# The final piece in layer 2
+    @staticmethod
+    def slots_of_kind(n):
+        return [s for s in range(0, len(CUBIE_SLOTS)) if len(CUBIE_SLOTS[s]) == n]
 
-cube_solver.add_target_constraint(1, 5, 1)
-cube_solver.add_target_constraint(3, 7, 3)
-model = cube_solver.solve_minimum()
+    @staticmethod
+    def find_sticker(position):
+        for s in range(0, len(CUBIE_SLOTS)):
+            if position in CUBIE_SLOTS[s]:
+                return (s, CUBIE_SLOTS[s].index(position))
 
-cube_solver.print_moves(0, 3)
-cube_solver.print_cube()
+    def set_start_constraints(self):
+        constraints = []
+        for s in range(0, len(CUBIE_SLOTS)):
+            if self.positions[s] is None:
+                continue
+            kind = CubieState.slots_of_kind(len(CUBIE_SLOTS[s]))
+            constraints.append(self.positions[s] == kind.index(s))
+            constraints.append(self.orientations[s] == 0)
+        return z3.And(constraints)
+
+    # Same scheme as CubeState.define_next_state, on cubie slots: every bit of
+    # the next state is a selection over the slots its cubie can come from.
+    # moves is a list of (value of the move variable, move number or
+    # MacroMove).
+    def define_next_state(self, move, final_state, moves):
+        constraints = []
+        for s in range(0, len(CUBIE_SLOTS)):
+            if self.positions[s] is None:
+                continue
+            n = len(CUBIE_SLOTS[s])
+            sources = {}
+            for (i, m) in moves:
+                if get_cubie_move(m)[s] != (s, 0):
+                    sources.setdefault(get_cubie_move(m)[s], []).append(i)
+            conditions = {}
+            for (source, ms) in sources.items():
+                conditions[source] = z3.Or([move == m for m in ms])
+
+            for bit in range(0, self.positions[s].size):
+                value = self.positions[s].array[bit]
+                for ((source, shift), condition) in conditions.items():
+                    value = z3.If(condition,
+                               self.positions[source].array[bit], value)
+                constraints.append(
+                    final_state.positions[s].array[bit] == value)
+
+            for bit in range(0, self.orientations[s].size):
+                value = self.orientations[s].array[bit]
+                for ((source, shift), condition) in conditions.items():
+                    # the orientation grows by the shift
+                    shifted = z3.Or([self.orientations[source] == o for o in range(0, n)
+                                  if ((o+shift) % n >> bit) & 1 == 1])
+                    value = z3.If(condition, shifted, value)
+                constraints.append(
+                    final_state.orientations[s].array[bit] == value)
+        return z3.And(constraints)
 
 
-# Top face Cross
-cube_solver.add_target_constraint(5, 1, 5)
-cube_solver.add_target_constraint(5, 3, 5)
+# A CubePath over CubieStates. Targets are still given per sticker and are
+# translated to the cubies (with their orientations) that would show the
+# wanted colour there, so set_init_constraints has to be called first.
+class CubiePath(CubePath):
+    def new_state(self, id):
+        return CubieState(id)
 
-model = cube_solver.solve_minimum()
+    def set_init_constraints(self, value_cube):
+        stickers = value_cube.get_stickers()
+        self.colors = [[stickers[p] for p in slot] for slot in CUBIE_SLOTS]
+        self.constraints.append(self.states[0].set_start_constraints())
+
+    def get_target_constraint(self, face, index, value, depth=None):
+        if depth is None:
+            depth = len(self.states)-1
+        state = self.states[depth]
+        (s, k) = CubieState.find_sticker(face*9+index)
+        n = len(CUBIE_SLOTS[s])
+        if n == 1:
+            return z3.BoolVal(self.colors[s][0] == value)
+        options = []
+        kind = CubieState.slots_of_kind(n)
+        for cubie in range(0, len(kind)):
+            for o in range(0, n):
+                if self.colors[kind[cubie]][(k+o) % n] == value:
+                    options.append(z3.And(state.positions[s] == cubie,
+                                       state.orientations[s] == o))
+        return z3.Or(options)
+
+    def get_transition(self, last_state, move, final_state):
+        if any(m >= SLICE_TURNS for m in self.move_set):
+            raise Exception("The cubie encoding cannot move the centres")
+        return last_state.define_next_state(
+            move, final_state, list(enumerate(self.get_move_choices())))
+
+    # The cube at the given step of a model
+    def get_value_cube(self, model, depth=None):
+        if depth is None:
+            depth = len(self.states)-1
+        state = self.states[depth]
+        stickers = [0]*54
+        for s in range(0, len(CUBIE_SLOTS)):
+            slot = CUBIE_SLOTS[s]
+            n = len(slot)
+            if n == 1:
+                stickers[slot[0]] = self.colors[s][0]
+                continue
+            cubie = CubieState.slots_of_kind(n)[
+                state.positions[s].get_int_value_from_model(model)]
+            o = state.orientations[s].get_int_value_from_model(model)
+            for k in range(0, n):
+                stickers[slot[k]] = self.colors[cubie][(k+o) % n]
+        return CompactCube(stickers).to_value_cube()
+
+
+class IncrementalCubiePath(IncrementalCubePath, CubiePath):
+    pass
+
+
+# Iterative deepening A* over the moves of a move set for a set of target
+# stickers. Only the cubies that could end up satisfying a target matter, so
+# the search state is the position of the first sticker of each such cubie
+# (a cubie moves rigidly, so that position fixes where its other stickers
+# are). The heuristic is a maximum over small pattern databases, one per
+# target cubie slot: for every candidate cubie, the exact number of moves
+# needed to bring it into the slot with the target colours showing. The
+# search prunes the same redundant sequences as CubePath.add_helper_constraints
+# and puts commuting moves on the layers of an axis in a fixed order, so the
+# sequence it returns is optimal.
+class IdaSearch:
+    def __init__(self, value_cube, target_constraints, restricted=False,
+                 moves=MOVE_SETS["quarter"]):
+        self.moves = []
+        for move in moves:
+            if restricted and get_move_layer(move) in [4, 5]:
+                continue
+            self.moves.append(move)
+        self.half_turns = any(move >= HALF_TURNS for move in moves)
+        # where a sticker at position p ends up after the move
+        self.destinations = [MOVE_PERMUTATIONS[get_inverse_move(move)]
+                             for move in range(0, len(MOVE_PERMUTATIONS))]
+        self.nodes = 0
+
+        stickers = value_cube.get_stickers()
+        slot_targets = {}
+        for (face, index, value) in target_constraints:
+            position = face*9+index
+            for slot in CUBIE_SLOTS:
+                if position in slot:
+                    slot_targets.setdefault(slot, {})[position] = value
+
+        self.start = []
+        self.groups = []
+        cubie_ids = {}
+        for (target_slot, targets) in slot_targets.items():
+            group = []
+            for slot in CUBIE_SLOTS:
+                if len(slot) != len(target_slot):
+                    continue
+                table = self.build_table(
+                    slot, [stickers[p] for p in slot], targets)
+                if table is None:
+                    continue
+                if slot not in cubie_ids:
+                    cubie_ids[slot] = len(self.start)
+                    self.start.append(slot[0])
+                group.append((cubie_ids[slot], table))
+            if len(group) == 0:
+                raise Exception("Targets cannot be reached")
+            self.groups.append(group)
+        self.start = tuple(self.start)
+
+    # Distance, indexed by the position of the cubie's first sticker, from
+    # every placement of the cubie to the nearest one where its colours
+    # satisfy the targets. None if no placement does.
+    def build_table(self, slot, colors, targets):
+        placements = {slot[0]: slot}
+        frontier = [slot]
+        while len(frontier) > 0:
+            next_frontier = []
+            for placement in frontier:
+                for move in self.moves:
+                    destination = self.destinations[move]
+                    moved = tuple(destination[p] for p in placement)
+                    if moved[0] not in placements:
+                        placements[moved[0]] = moved
+                        next_frontier.append(moved)
+            frontier = next_frontier
+
+        table = [None]*54
+        frontier = []
+        for (first, placement) in placements.items():
+            shown = dict(zip(placement, colors))
+            if all(shown.get(p) == v for (p, v) in targets.items()):
+                table[first] = 0
+                frontier.append(first)
+        if len(frontier) == 0:
+            return None
+        distance = 0
+        while len(frontier) > 0:
+            distance = distance+1
+            next_frontier = []
+            for first in frontier:
+                for move in self.moves:
+                    moved = self.destinations[move][first]
+                    if table[moved] is None:
+                        table[moved] = distance
+                        next_frontier.append(moved)
+            frontier = next_frontier
+        return table
+
+    def heuristic(self, state):
+        h = 0
+        for group in self.groups:
+            best = None
+            for (cubie, table) in group:
+                d = table[state[cubie]]
+                if best is None or d < best:
+                    best = d
+            if best > h:
+                h = best
+        return h
+
+    # The most that a step making the sticker permutation lowers the heuristic
+    # by: a move lowers every table entry by at most one, a macro by as much
+    # as it brings any placement closer. None if the permutation takes a
+    # placement where the moves cannot.
+    def get_step_reach(self, permutation):
+        destination = [0]*54
+        for i in range(0, 54):
+            destination[permutation[i]] = i
+        reach = 1
+        for group in self.groups:
+            for (cubie, table) in group:
+                for p in range(0, 54):
+                    if table[p] is None:
+                        continue
+                    if table[destination[p]] is None:
+                        return None
+                    reach = max(reach, table[p]-table[destination[p]])
+        return reach
+
+    def is_redundant(self, move, prev_move, prev_prev_move):
+        if prev_move is None:
+            return False
+        layer = get_move_layer(move)
+        prev_layer = get_move_layer(prev_move)
+        if move == get_inverse_move(prev_move):
+            return True
+        # with half turns every pair of moves of a layer is a single move
+        if layer == prev_layer and self.half_turns:
+            return True
+        if move == prev_move and (move % 2 == 1 or move == prev_prev_move):
+            return True
+        # moves on the layers of an axis commute, only try them in one order
+        return get_layer_axis(layer) == get_layer_axis(prev_layer) and layer < prev_layer
+
+    def search(self, state, depth, bound, path):
+        self.nodes = self.nodes+1
+        h = self.heuristic(state)
+        if h == 0:
+            return True
+        if depth+h > bound:
+            return False
+        prev_move = path[-1] if len(path) > 0 else None
+        prev_prev_move = path[-2] if len(path) > 1 else None
+        for move in self.moves:
+            if self.is_redundant(move, prev_move, prev_prev_move):
+                continue
+            destination = self.destinations[move]
+            path.append(move)
+            if self.search(tuple(destination[p] for p in state), depth+1, bound, path):
+                return True
+            path.pop()
+        return False
+
+    def solve(self, max_depth=20):
+        bound = self.heuristic(self.start)
+        while bound <= max_depth:
+            path = []
+            if self.search(self.start, 0, bound, path):
+                return path
+            bound = bound+1
+        return None
+
+
+# Bidirectional breadth first search over the same cubie abstraction as
+# IdaSearch, for phases whose goal is (close to) fully specified. One frontier
+# grows from the start cube and one backwards from every goal consistent
+# placement of the tracked cubies; the smaller one is expanded a whole layer at
+# a time until they meet, so a phase of depth d costs about 2*12^(d/2) states
+# instead of 12^d. Both directions are hash indexed and the search gives up
+# once max_states states are stored.
+class MeetInTheMiddleSearch(IdaSearch):
+    def __init__(self, value_cube, target_constraints, restricted=False,
+                 moves=MOVE_SETS["quarter"], max_states=4000000, max_goal_states=100000):
+        super().__init__(value_cube, target_constraints, restricted, moves)
+        self.max_states = max_states
+        # (direction, depth, number of states in the new layer)
+        self.frontier_sizes = []
+        self.slot_of = {}
+        for i in range(0, len(CUBIE_SLOTS)):
+            for position in CUBIE_SLOTS[i]:
+                self.slot_of[position] = i
+        self.reachable = [None]*len(self.start)
+        for group in self.groups:
+            for (cubie, table) in group:
+                self.reachable[cubie] = [
+                    p for p in range(0, 54) if table[p] is not None]
+        self.goals = []
+        self.add_goals(0, [None]*len(self.start), set(), max_goal_states)
+
+    # Every way of satisfying the target slots with distinct cubies, with the
+    # cubies left over placed anywhere else
+    def add_goals(self, g, placement, used_slots, limit):
+        if len(self.goals) > limit:
+            raise Exception("The goal is not specified well enough for meet in the middle")
+        if g == len(self.groups):
+            self.add_free_placements(0, placement, used_slots, limit)
+            return
+        for (cubie, table) in self.groups[g]:
+            if placement[cubie] is not None:
+                continue
+            for first in self.reachable[cubie]:
+                if table[first] != 0 or self.slot_of[first] in used_slots:
+                    continue
+                placement[cubie] = first
+                used_slots.add(self.slot_of[first])
+                self.add_goals(g+1, placement, used_slots, limit)
+                used_slots.remove(self.slot_of[first])
+                placement[cubie] = None
+
+    def add_free_placements(self, cubie, placement, used_slots, limit):
+        if len(self.goals) > limit:
+            raise Exception("The goal is not specified well enough for meet in the middle")
+        if cubie == len(placement):
+            self.goals.append(tuple(placement))
+            return
+        if placement[cubie] is not None:
+            self.add_free_placements(cubie+1, placement, used_slots, limit)
+            return
+        for first in self.reachable[cubie]:
+            if self.slot_of[first] in used_slots:
+                continue
+            placement[cubie] = first
+            used_slots.add(self.slot_of[first])
+            self.add_free_placements(cubie+1, placement, used_slots, limit)
+            used_slots.remove(self.slot_of[first])
+        placement[cubie] = None
+
+    # Expands one layer. visited maps a state to (neighbour, move, depth) where
+    # the move leads from the state to the neighbour (backwards) or from the
+    # neighbour to the state (forwards). Returns the new layer and the state
+    # in it that meets the other side with the shortest total path.
+    def expand(self, frontier, visited, other, forwards):
+        next_frontier = []
+        meet = None
+        for state in frontier:
+            depth = visited[state][2]+1
+            for move in self.moves:
+                if forwards:
+                    destination = self.destinations[move]
+                else:
+                    destination = self.destinations[get_inverse_move(move)]
+                moved = tuple(destination[p] for p in state)
+                if moved in visited:
+                    continue
+                visited[moved] = (state, move, depth)
+                next_frontier.append(moved)
+                if moved in other and (meet is None or other[moved][2] < other[meet][2]):
+                    meet = moved
+        return (next_frontier, meet)
+
+    def solve(self, max_depth=20):
+        forward = {self.start: (None, None, 0)}
+        backward = {}
+        for goal in self.goals:
+            backward[goal] = (None, None, 0)
+        if self.start in backward:
+            return []
+        forward_frontier = [self.start]
+        backward_frontier = list(self.goals)
+        forward_depth = 0
+        backward_depth = 0
+        meet = None
+        while meet is None:
+            if forward_depth+backward_depth >= max_depth:
+                return None
+            if len(forward)+len(backward) > self.max_states:
+                return None
+            if len(forward_frontier) <= len(backward_frontier):
+                (forward_frontier, meet) = self.expand(
+                    forward_frontier, forward, backward, True)
+                forward_depth = forward_depth+1
+                self.frontier_sizes.append(
+                    ("forward", forward_depth, len(forward_frontier)))
+            else:
+                (backward_frontier, meet) = self.expand(
+                    backward_frontier, backward, forward, False)
+                backward_depth = backward_depth+1
+                self.frontier_sizes.append(
+                    ("backward", backward_depth, len(backward_frontier)))
+            if len(forward_frontier) == 0 or len(backward_frontier) == 0:
+                return None
+            self.nodes = len(forward)+len(backward)
+
+        path = []
+        state = meet
+        while forward[state][0] is not None:
+            path.append(forward[state][1])
+            state = forward[state][0]
+        path.reverse()
+        state = meet
+        while backward[state][0] is not None:
+            path.append(backward[state][1])
+            state = backward[state][0]
+        return path
+
+
+# Position of the centre of a sticker in a cube with its centre at the origin
+# and edges 3 long, and its face. The sticker at (h, v) of a face of axis a
+# lies at h-1 along axis a+1 and v-1 along axis a+2.
+def get_sticker_coordinates(position):
+    face = position//9
+    index = position % 9
+    axis = face//2
+    point = [0, 0, 0]
+    point[axis] = 2*(face % 2)-1
+    point[(axis+1) % 3] = index % 3-1
+    point[(axis+2) % 3] = index//3-1
+    return (tuple(point), face)
+
+
+# A symmetry of the cube as a map of the stickers: the sticker at position p
+# goes to positions[p] and colour c (the colour of the centre of face c on a
+# solved cube) becomes colors[c], so a solved cube stays solved. moves[m] is
+# the move that does to the mapped cube what move m does to the cube.
+class CubeSymmetry:
+    def __init__(self, matrix, positions, colors):
+        self.matrix = matrix
+        self.positions = positions
+        self.colors = colors
+        self.moves = None
+        self.inverse = None
+
+    def apply_stickers(self, stickers):
+        mapped = [0]*54
+        for p in range(0, 54):
+            mapped[self.positions[p]] = self.colors[stickers[p]]
+        return mapped
+
+    def apply_cube(self, value_cube):
+        return CompactCube(self.apply_stickers(value_cube.get_stickers())).to_value_cube()
+
+    def apply_targets(self, target_constraints):
+        targets = []
+        for (face, index, value) in target_constraints:
+            position = self.positions[face*9+index]
+            targets.append((position//9, position % 9, self.colors[value]))
+        return targets
+
+    def apply_moves(self, move_numbers):
+        return [self.moves[move] for move in move_numbers]
+
+    # Keeps the two faces a restricted path may not turn
+    def is_restriction_safe(self):
+        return self.colors[4] in [4, 5]
+
+
+# The 24 rotations and 24 mirror images of the cube, one per signed
+# permutation of the axes. The first one is the identity.
+def compile_symmetries():
+    coordinates = [get_sticker_coordinates(p) for p in range(0, 54)]
+    position_of = dict((coordinates[p], p) for p in range(0, 54))
+    destinations = []
+    for permutation in MOVE_PERMUTATIONS:
+        destination = [0]*54
+        for p in range(0, 54):
+            destination[permutation[p]] = p
+        destinations.append(tuple(destination))
+    move_of = {}
+    for move in range(len(MOVE_PERMUTATIONS)-1, -1, -1):
+        move_of[destinations[move]] = move
+
+    symmetries = []
+    for axes in [(0, 1, 2), (1, 2, 0), (2, 0, 1), (0, 2, 1), (2, 1, 0), (1, 0, 2)]:
+        for signs in range(0, 8):
+            # axis k of the image is axis axes[k] of the original
+            matrix = [(axes[k], 1-2*((signs >> k) & 1)) for k in range(0, 3)]
+
+            def transform(point):
+                return tuple(matrix[k][1]*point[matrix[k][0]] for k in range(0, 3))
+
+            def transform_face(face):
+                normal = [0, 0, 0]
+                normal[face//2] = 2*(face % 2)-1
+                normal = transform(normal)
+                axis = [k for k in range(0, 3) if normal[k] != 0][0]
+                return axis*2+(1 if normal[axis] > 0 else 0)
+            positions = [position_of[(transform(point), transform_face(face))]
+                         for (point, face) in coordinates]
+            colors = [transform_face(face) for face in range(0, 6)]
+            symmetries.append(CubeSymmetry(matrix, positions, colors))
+
+    for symmetry in symmetries:
+        inverse = [0]*54
+        for p in range(0, 54):
+            inverse[symmetry.positions[p]] = p
+        symmetry.inverse = [s for s in symmetries if s.positions == inverse][0]
+        symmetry.moves = []
+        for destination in destinations:
+            conjugated = tuple(symmetry.positions[destination[inverse[p]]]
+                               for p in range(0, 54))
+            symmetry.moves.append(move_of[conjugated])
+    return symmetries
+
+
+SYMMETRIES = []
+
+
+# compile_symmetries, compiled on first use
+def get_symmetries():
+    if len(SYMMETRIES) == 0:
+        SYMMETRIES.extend(compile_symmetries())
+    return SYMMETRIES
+
+
+# The representative of the symmetry class of a cube and its targets: the
+# image under the symmetry giving the smallest targets and stickers. Returns
+# the representative cube, its targets and the symmetry that maps it (and the
+# moves solving it) back. A restricted problem only uses the symmetries that
+# keep the restricted faces.
+def canonicalize(value_cube, target_constraints, restricted=False):
+    stickers = value_cube.get_stickers()
+    best = None
+    for symmetry in get_symmetries():
+        if restricted and not symmetry.is_restriction_safe():
+            continue
+        targets = sorted(symmetry.apply_targets(target_constraints))
+        key = (targets, symmetry.apply_stickers(stickers))
+        if best is None or key < best[0]:
+            best = (key, symmetry)
+    ((targets, mapped), symmetry) = best
+    return (CompactCube(mapped).to_value_cube(), targets, symmetry.inverse)
+
+
+# Solutions of earlier solve_minimum calls in an SQLite file, keyed by the
+# start cube, the sorted targets, the restriction and the move set (CubeSolver
+# stores the representative of the symmetry class of the cube). Every
+# entry keeps the move numbers and the cube they lead to, and the least
+# recently used entries are dropped once there are more than max_entries.
+class SolutionCache:
+    def __init__(self, path, max_entries=100000):
+        import sqlite3
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path)
+        # the LRU stamp is written on every hit, do not wait for the disk
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS solutions (key TEXT PRIMARY KEY, "
+            "moves BLOB, stickers BLOB, used INTEGER)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS solutions_used ON solutions (used)")
+        self.connection.commit()
+        self.clock = self.connection.execute(
+            "SELECT COALESCE(MAX(used), 0) FROM solutions").fetchone()[0]
 
-cube_solver.print_moves(0, 3)
-cube_solver.print_cube()
+    @staticmethod
+    def get_key(value_cube, target_constraints, restricted, move_set):
+        targets = ",".join("%d.%d.%d" % c for c in sorted(target_constraints))
+        return "%s|%s|%d|%s" % (bytes(value_cube.get_stickers()).hex(),
+                                targets, int(restricted), move_set)
+
+    def tick(self):
+        self.clock = self.clock+1
+        return self.clock
+
+    # (move numbers, ValueCube after them), or None on a miss
+    def get(self, key):
+        row = self.connection.execute(
+            "SELECT moves, stickers FROM solutions WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses = self.misses+1
+            return None
+        self.hits = self.hits+1
+        self.connection.execute(
+            "UPDATE solutions SET used = ? WHERE key = ?", (self.tick(), key))
+        self.connection.commit()
+        return (list(row[0]), CompactCube(row[1]).to_value_cube())
+
+    def put(self, key, move_numbers, value_cube):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO solutions VALUES (?, ?, ?, ?)",
+            (key, bytes(move_numbers), bytes(value_cube.get_stickers()), self.tick()))
+        self.connection.execute(
+            "DELETE FROM solutions WHERE key IN (SELECT key FROM solutions "
+            "ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM solutions").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+# A last layer case is a cube that is solved but for the 4 corners of the top
+# face (face 5). It is numbered by the rank of the permutation of those corners
+# times 81 plus the rank of their twists, a twist being how far the top colour
+# of the corner is turned from the top sticker of its slot.
+LAST_LAYER_CASES = 24*81
+
+
+def get_top_corner_slots():
+    return [slot for slot in CUBIE_SLOTS
+            if len(slot) == 3 and any(p//9 == 5 for p in slot)]
+
+
+# Index of the top sticker in a corner slot
+def get_top_index(slot):
+    return [p//9 for p in slot].index(5)
+
+
+# Rank of a permutation of 0..n-1 in lexicographic order
+def rank_permutation(permutation):
+    rank = 0
+    for i in range(0, len(permutation)):
+        smaller = [p for p in permutation[i+1:] if p < permutation[i]]
+        rank = rank*(len(permutation)-i)+len(smaller)
+    return rank
+
+
+# The case number of a cube given by its stickers, None if it is not a last
+# layer case
+def get_last_layer_case(stickers):
+    slots = get_top_corner_slots()
+    top = set(p for slot in slots for p in slot)
+    for p in range(0, 54):
+        if p not in top and stickers[p] != p//9:
+            return None
+    homes = [set(p//9 for p in slot) for slot in slots]
+    cubies = []
+    twists = 0
+    for i in range(len(slots)-1, -1, -1):
+        colors = [stickers[p] for p in slots[i]]
+        if set(colors) not in homes:
+            return None
+        cubies.insert(0, homes.index(set(colors)))
+        twists = twists*3+(colors.index(5)-get_top_index(slots[i])) % 3
+    if len(set(cubies)) != len(cubies):
+        return None
+    return rank_permutation(cubies)*81+twists
+
+
+# The case with corner cubies[i] in top corner slot i with twist twists[i]
+def make_last_layer_case(cubies, twists):
+    slots = get_top_corner_slots()
+    stickers = [p//9 for p in range(0, 54)]
+    for i in range(0, len(slots)):
+        home = slots[cubies[i]]
+        shift = get_top_index(slots[i])+twists[i]-get_top_index(home)
+        for k in range(0, 3):
+            stickers[slots[i][(k+shift) % 3]] = home[k]//9
+    return CompactCube(stickers).to_value_cube()
+
+
+# Every case reachable from a solved cube: as the edges are solved, the
+# corners are evenly permuted, and their twists add up to a multiple of 3.
+def get_last_layer_cases():
+    import itertools
+    cases = []
+    for cubies in itertools.permutations(range(0, 4)):
+        inversions = [(i, j) for i in range(0, 4) for j in range(i+1, 4)
+                      if cubies[i] > cubies[j]]
+        if len(inversions) % 2 == 1:
+            continue
+        for twists in itertools.product(range(0, 3), repeat=4):
+            if sum(twists) % 3 == 0:
+                cases.append(make_last_layer_case(cubies, twists))
+    return cases
+
+
+# Optimal solutions of the restricted phases of a plan for every last layer
+# case, in a file that is memory mapped and read a record at a time. The file
+# is b"LLT1", the length of a JSON header (little endian uint32), the header
+# (move set, record size and the phase and targets of every table), then for
+# every table LAST_LAYER_CASES records: the number of moves (255 for a case
+# the table does not have) followed by the move numbers, zero padded.
+class LastLayerTables:
+    def __init__(self, path):
+        import mmap
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[0:4] != b"LLT1":
+            raise Exception(path+" is not a last layer table file")
+        length = int.from_bytes(self.map[4:8], "little")
+        self.header = json.loads(self.map[8:8+length])
+        self.start = 8+length
+        self.record_size = self.header["record_size"]
+        self.tables = {}
+        for (i, table) in enumerate(self.header["tables"]):
+            self.tables[tuple(sorted(tuple(c) for c in table["targets"]))] = i
+
+    # The move numbers solving a restricted phase from value_cube, or None if
+    # no table has its targets and move set or the cube is not a tabled case
+    def lookup(self, value_cube, target_constraints, restricted, move_set):
+        if not restricted or move_set != self.header["move_set"]:
+            return None
+        table = self.tables.get(tuple(sorted(target_constraints)))
+        if table is None:
+            return None
+        case = get_last_layer_case(value_cube.get_stickers())
+        if case is None:
+            return None
+        offset = self.start+(table*LAST_LAYER_CASES+case)*self.record_size
+        length = self.map[offset]
+        if length == 255:
+            return None
+        return list(self.map[offset+1:offset+1+length])
+
+    def close(self):
+        self.map.close()
+
+
+# Worker process of the parallel depth portfolio: checks a single depth and
+# sends back ("sat", move numbers), ("unsat", None) or ("unknown", None).
+def check_depth(cube_solver, depth, connection):
+    cube_path = cube_solver.new_path(depth)
+    (res, model, statistics) = cube_solver.check_constraints(
+        cube_path.get_constraints())
+    if res == "sat":
+        connection.send(("sat", cube_path.get_move_numbers(model)))
+    else:
+        connection.send((res, None))
+    connection.close()
+
+
+# Receives what a CubeSolver does. depth gets a record per checked depth:
+# depth, result ("sat", "unsat" or "unknown"), encode_ms and solve_ms and, from
+# the z3 statistics, conflicts, decisions and memory (MB) when z3 has them. A
+# depth of the parallel portfolio only has seconds since the portfolio started
+# instead of the encode and solve times.
+# phase gets a record per solve_minimum call: depth (in steps, which are fewer
+# than moves, the length of the solution, when a step can be a macro), moves,
+# seconds, backend, whether it came from the cache or a last layer table and
+# what the backend adds (nodes of a search, the lower_bound the sat depth loop
+# started from). start and stop are called around the "encode" and
+# "solve" stages.
+class SolverEvents:
+    def start(self, stage):
+        pass
+
+    def stop(self, stage):
+        pass
+
+    def depth(self, record):
+        pass
+
+    def phase(self, record):
+        pass
+
+
+# Builds a depth record from the times in seconds and a dict of z3 statistics
+def get_depth_record(depth, result, encode_seconds, solve_seconds, statistics):
+    record = {"depth": depth, "result": str(result),
+              "encode_ms": encode_seconds*1000, "solve_ms": solve_seconds*1000}
+    for (key, names) in [("conflicts", ["conflicts", "sat conflicts"]),
+                         ("decisions", ["decisions", "sat decisions"]),
+                         ("memory", ["max memory", "memory"])]:
+        for name in names:
+            if name in statistics:
+                record[key] = statistics[name]
+                break
+    return record
 
-cube_solver.add_target_constraint(5, 5, 5)
-cube_solver.add_target_constraint(5, 7, 5)
-model = cube_solver.solve_minimum()
 
-cube_solver.print_moves(0, 3)
-cube_solver.print_cube()
+# Sends the records to the "solve" logger, at INFO, with the record itself in
+# the record attribute of the log record for handlers that want the fields.
+class LoggingEvents(SolverEvents):
+    def depth(self, record):
+        if "seconds" in record:
+            logger.info("depth %d: %s after %.3f s", record["depth"],
+                        record["result"], record["seconds"], extra={"record": record})
+        else:
+            logger.info("depth %d: %s, encode %.1f ms, solve %.1f ms",
+                        record["depth"], record["result"], record["encode_ms"],
+                        record["solve_ms"], extra={"record": record})
+
+    def phase(self, record):
+        if "lower_bound" in record:
+            logger.info("%d moves in %.3f s, lower bound %d", record["moves"],
+                        record["seconds"], record["lower_bound"],
+                        extra={"record": record})
+        else:
+            logger.info("%d moves in %.3f s", record["moves"], record["seconds"],
+                        extra={"record": record})
 
 
-# Top face cross matching sides
-cube_solver.add_target_constraint(1, 7, 1)
-cube_solver.add_target_constraint(3, 5, 3)
-# model = cube_solver.solve_minimum()
+# Keeps all the records
+class RecordingEvents(SolverEvents):
+    def __init__(self):
+        self.depths = []
+        self.phases = []
+
+    def depth(self, record):
+        self.depths.append(record)
+
+    def phase(self, record):
+        self.phases.append(record)
+
+
+# Profiles the stages with cProfile and, if memory is set, tracks their peak
+# memory with tracemalloc, passing the records on to events.
+class ProfilingEvents(SolverEvents):
+    def __init__(self, events=None, profile=True, memory=False):
+        self.events = events if events is not None else SolverEvents()
+        self.profiles = {}
+        self.memory = memory
+        self.profile = profile
+        # stage -> the highest peak of traced memory in bytes
+        self.peaks = {}
+
+    def start(self, stage):
+        import cProfile
+        import tracemalloc
+        self.events.start(stage)
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        if self.profile:
+            self.profiles.setdefault(stage, cProfile.Profile()).enable()
+
+    def stop(self, stage):
+        import tracemalloc
+        if self.profile:
+            self.profiles[stage].disable()
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            self.peaks[stage] = max(self.peaks.get(stage, 0), peak)
+        self.events.stop(stage)
+
+    def depth(self, record):
+        self.events.depth(record)
+
+    def phase(self, record):
+        self.events.phase(record)
+
+    def print_stats(self, stage, sort="cumulative", limit=20):
+        import pstats
+        pstats.Stats(self.profiles[stage]).sort_stats(sort).print_stats(limit)
 
-# cube_solver.print_moves(0, 3)
-# cube_solver.print_cube()
 
+# An incremental cube solver
+class CubeSolver:
+    def __init__(self, starting_cube: ValueCube):
+        self.value_cube = starting_cube
+        self.target_constraints = []
+        self.restricted = False
+        self.incremental = False
+        self.shared_path = None
+        self.backend = "sat"
+        self.sat_solver = "z3"
+        self.processes = 1
+        self.optimize_depth = None
+        self.max_depth = None
+        self.cache = None
+        self.tables = None
+        self.events = LoggingEvents()
+        self.move_set = "quarter"
+        self.macros = []
+        self.move_encoding = "onehot"
+        self.transition_encoding = "implication"
+        self.state_encoding = "sticker"
+        self.pruning_level = 1
+        self.pruning_length = 4
+        self.model = None
+        self.solution = []
 
-cube_solver.add_target_constraint(2, 5, 2)
-cube_solver.add_target_constraint(0, 7, 0)
+    def add_target_constraint(self, face, index, value):
+        self.target_constraints.append((face, index, value))
 
-model = cube_solver.solve_minimum()
+    def set_restricted(self):
+        self.restricted = True
 
-cube_solver.print_moves(0, 3)
-cube_solver.print_cube()
+    # Use one persistent solver for all the depths of a solve_minimum call
+    # instead of a fresh CubePath and Solver per depth.
+    def set_incremental(self):
+        self.incremental = True
+
+    def set_move_encoding(self, move_encoding):
+        if move_encoding not in MOVE_ENCODINGS:
+            raise Exception("Unknown move encoding "+move_encoding)
+        self.move_encoding = move_encoding
+
+    # "quarter" turns only, "half" adds the 6 half turns and "slice" the
+    # quarter and half turns of the 3 middle slices as well
+    def set_move_set(self, move_set):
+        if move_set not in MOVE_SETS:
+            raise Exception("Unknown move set "+move_set)
+        self.move_set = move_set
+
+    # Let every step of the sat backend also be one of the macros, a dict of
+    # names and move strings such as MACROS, so a phase that needs a long
+    # sequence is found a few steps deep. The solution is still in the moves
+    # of the move set (the half turns of a macro are two quarter turns on a
+    # quarter path), but it is only the shortest in steps, and the search
+    # backends and the solution cache ignore macros.
+    def set_macros(self, macros=MACROS):
+        self.macros = compile_macros(macros)
+
+    def set_transition_encoding(self, transition_encoding):
+        if transition_encoding not in ["implication", "functional"]:
+            raise Exception(
+                "Unknown transition encoding "+transition_encoding)
+        self.transition_encoding = transition_encoding
+
+    # "sticker" models the cube with CubeState, "cubie" with CubieState
+    def set_state_encoding(self, state_encoding):
+        if state_encoding not in ["sticker", "cubie"]:
+            raise Exception("Unknown state encoding "+state_encoding)
+        self.state_encoding = state_encoding
+
+    def set_pruning_level(self, level, length=4):
+        if level not in [0, 1, 2, 3]:
+            raise Exception("Unknown pruning level "+str(level))
+        self.pruning_level = level
+        self.pruning_length = length
+
+    def configure_path(self, cube_path):
+        cube_path.set_pruning_level(self.pruning_level, self.pruning_length)
+        cube_path.set_move_set(self.move_set)
+        cube_path.set_macros(self.macros)
+        cube_path.set_move_encoding(self.move_encoding)
+        cube_path.set_transition_encoding(self.transition_encoding)
+        if self.restricted:
+            cube_path.set_restricted_movement()
+
+    # Prints the size of the depth-n problem under every move encoding
+    def print_encoding_sizes(self, depth):
+        move_encoding = self.move_encoding
+        for encoding in MOVE_ENCODINGS:
+            self.move_encoding = encoding
+            (variables, clauses) = self.new_path(depth).get_cnf_size()
+            print("%s: %d variables, %d clauses" %
+                  (encoding, variables, clauses))
+        self.move_encoding = move_encoding
+
+    # Solve on a SharedCubePath that can be handed to several solvers.
+    def set_shared_path(self, shared_path):
+        self.shared_path = shared_path
+
+    # "sat" solves with z3, "ida" with IdaSearch, which is much faster on the
+    # short phases, and "mitm" with MeetInTheMiddleSearch, for the phases with
+    # a fully specified goal.
+    def set_backend(self, backend):
+        if backend not in ["sat", "ida", "mitm"]:
+            raise Exception("Unknown backend "+backend)
+        self.backend = backend
+
+    # "z3" solves the constraints with z3, any other name hands their CNF to
+    # one of SAT_SOLVERS. Only z3 can solve incrementally or optimize.
+    def set_sat_solver(self, sat_solver):
+        if sat_solver != "z3" and sat_solver not in SAT_SOLVERS:
+            raise Exception("Unknown sat solver "+sat_solver)
+        self.sat_solver = sat_solver
+
+    # Checks phi with the sat solver: (result, model or None, statistics), the
+    # result being "sat", "unsat" or "unknown"
+    def check_constraints(self, phi):
+        if self.sat_solver != "z3":
+            return SAT_SOLVERS[self.sat_solver]().solve(
+                CnfFormula.from_constraints(phi))
+        solver = z3.Solver()
+        solver.add(phi)
+        res = solver.check()
+        model = solver.model() if res == z3.sat else None
+        return (str(res), model, get_statistics(solver))
+
+    # Writes the depth-n problem as DIMACS
+    def write_dimacs(self, depth, output):
+        self.new_path(depth).get_cnf().write_dimacs(output)
+
+    # Where the depth and phase records go, a SolverEvents
+    def set_events(self, events):
+        self.events = events
+
+    # Look up and store the solutions in a SolutionCache
+    def set_cache(self, cache):
+        self.cache = cache
+
+    # Answer the restricted phases found in a LastLayerTables without solving
+    def set_tables(self, tables):
+        self.tables = tables
+
+    # Solve with a single Optimize call on a path of max_depth moves padded
+    # with no-ops, minimizing the number of real moves, instead of a check per
+    # depth. There must be a solution of at most max_depth moves.
+    def set_optimize(self, max_depth):
+        self.optimize_depth = max_depth
+
+    # Give up on a phase with an exception once no depth up to max_depth has
+    # a solution, instead of trying ever deeper
+    def set_max_depth(self, max_depth):
+        self.max_depth = max_depth
+
+    def __solve_minimum_optimize(self):
+        start_ts = time.perf_counter()
+        self.events.start("encode")
+        cube_path = self.new_path(self.optimize_depth, True)
+        phi = cube_path.get_constraints()
+        self.events.stop("encode")
+        encoded_ts = time.perf_counter()
+        self.events.start("solve")
+        (result, res) = minimize(phi, cube_path.get_move_count())
+        self.events.stop("solve")
+        self.events.depth(get_depth_record(
+            self.optimize_depth, result, encoded_ts-start_ts,
+            time.perf_counter()-encoded_ts, {}))
+        if result == "unsat":
+            raise Exception("No solution within %d moves" %
+                            self.optimize_depth)
+        if result != "sat":
+            raise Exception("Depth %d could not be decided" %
+                            self.optimize_depth)
+        self.model = res
+        self.cube_path = cube_path
+        self.solution = [move for move in cube_path.get_move_numbers(res)
+                         if move != 12]
+        self.depth = cube_path.get_step_count(res)
+        self.value_cube = self.value_cube.apply_move_numbers(self.solution)
+        return self.model
 
-# Top face one corner
-cube_solver.set_restricted()
-cube_solver.add_target_constraint(5, 0, 5)
-cube_solver.add_target_constraint(2, 2, 2)
-cube_solver.add_target_constraint(0, 6, 0)
+    def __solve_minimum_search(self):
+        moves = MOVE_SETS[self.move_set]
+        if self.backend == "mitm":
+            search = MeetInTheMiddleSearch(self.value_cube, self.target_constraints,
+                                           self.restricted, moves)
+        else:
+            search = IdaSearch(self.value_cube, self.target_constraints,
+                               self.restricted, moves)
+        self.events.start("solve")
+        if self.max_depth is None:
+            solution = search.solve()
+        else:
+            solution = search.solve(self.max_depth)
+        self.events.stop("solve")
+        if solution is None:
+            raise Exception("No solution within the search limits")
+        self.phase_record["nodes"] = search.nodes
+        if self.backend == "mitm":
+            self.phase_record["frontier_sizes"] = search.frontier_sizes
+        self.model = None
+        self.cube_path = None
+        self.depth = len(solution)
+        self.solution = solution
+        self.value_cube = self.value_cube.apply_move_numbers(solution)
+        return self.model
 
+    def __solve_minimum_incremental(self):
+        if self.shared_path is not None:
+            if self.state_encoding != "sticker":
+                raise Exception("A shared path needs the sticker encoding")
+            cube_path = self.shared_path
+            cube_path.select(self.value_cube, self.restricted)
+        elif self.state_encoding == "cubie":
+            cube_path = IncrementalCubiePath()
+            self.configure_path(cube_path)
+            cube_path.set_init_constraints(self.value_cube)
+        else:
+            cube_path = IncrementalCubePath()
+            self.configure_path(cube_path)
+            cube_path.set_init_constraints(self.value_cube)
 
-model = cube_solver.solve_minimum()
+        # a shared path has the moves it was made with
+        try_sat = self.get_depth_lower_bound(
+            cube_path.move_set, cube_path.macros)
+        self.phase_record["lower_bound"] = try_sat
+        while (True):
+            if self.max_depth is not None and try_sat > self.max_depth:
+                raise Exception("No solution within %d moves" % self.max_depth)
+            start_ts = time.perf_counter()
+            self.events.start("encode")
+            cube_path.extend_to(try_sat)
+            self.events.stop("encode")
+            encoded_ts = time.perf_counter()
+            self.events.start("solve")
+            res = cube_path.check_targets(self.target_constraints, try_sat)
+            self.events.stop("solve")
+            if res is None:
+                result = "unknown"
+            elif res == z3.unsat:
+                result = "unsat"
+            else:
+                result = "sat"
+            # the statistics add up over the depths
+            self.events.depth(get_depth_record(
+                try_sat, result, encoded_ts-start_ts,
+                time.perf_counter()-encoded_ts, get_statistics(cube_path.solver)))
+            if res is None:
+                raise Exception("Depth %d could not be decided" % try_sat)
+            if res != z3.unsat:
+                self.model = res
+                self.cube_path = cube_path
+                self.depth = try_sat
+                break
+            try_sat = try_sat+1
 
-cube_solver.print_moves(0, 3)
-cube_solver.print_cube()
+        self.solution = self.cube_path.get_move_numbers(self.model, self.depth)
+        self.value_cube = self.value_cube.apply_move_numbers(self.solution)
 
-# Top face another corner
-cube_solver.add_target_constraint(5, 6, 5)
-cube_solver.add_target_constraint(0, 8, 0)
-cube_solver.add_target_constraint(3, 2, 3)
+        return self.model
 
+    # A depth that the phase cannot be solved in fewer steps than: the
+    # IdaSearch heuristic of the cube, which is a number of moves of the move
+    # set, divided by the most that one of the macros lowers it by. The depth
+    # loops start there instead of proving every shallower depth unsat.
+    # moves and macros are those of the solver unless given.
+    def get_depth_lower_bound(self, moves=None, macros=None):
+        if moves is None:
+            moves = MOVE_SETS[self.move_set]
+        if macros is None:
+            macros = self.macros
+        search = IdaSearch(self.value_cube, self.target_constraints,
+                           self.restricted, moves)
+        reach = 1
+        for macro in macros:
+            if self.restricted and (4 in macro.layers or 5 in macro.layers):
+                continue
+            step_reach = search.get_step_reach(macro.permutation)
+            if step_reach is None:
+                reach = None
+                break
+            reach = max(reach, step_reach)
+        if reach is None:
+            return 0
+        return -(-search.heuristic(search.start)//reach)
+
+    def new_path(self, depth, padded=False):
+        if self.state_encoding == "cubie":
+            cube_path = CubiePath()
+        else:
+            cube_path = CubePath()
+        self.configure_path(cube_path)
+        if padded:
+            cube_path.set_padding()
+
+        cube_path.set_init_constraints(self.value_cube)
+
+        cube_path.add_n_rotations(depth)
+
+        for c in self.target_constraints:
+            cube_path.add_target_constraint(c[0], c[1], c[2])
+        return cube_path
+
+    # Check up to `processes` depths at the same time, each in its own process
+    def set_parallel(self, processes):
+        self.processes = processes
+
+    # What a worker process needs to check one depth
+    def copy_for_worker(self):
+        worker = CubeSolver(self.value_cube)
+        worker.target_constraints = list(self.target_constraints)
+        worker.restricted = self.restricted
+        worker.move_set = self.move_set
+        worker.macros = self.macros
+        worker.move_encoding = self.move_encoding
+        worker.transition_encoding = self.transition_encoding
+        worker.state_encoding = self.state_encoding
+        worker.pruning_level = self.pruning_level
+        worker.pruning_length = self.pruning_length
+        worker.optimize_depth = self.optimize_depth
+        worker.max_depth = self.max_depth
+        worker.sat_solver = self.sat_solver
+        return worker
+
+    # Runs depths k, k+1, ... k+processes-1 concurrently. A sat depth stops all
+    # the deeper ones still running, and the answer is the smallest sat depth
+    # once every depth below it is known to be unsat.
+    def __solve_minimum_parallel(self):
+        import multiprocessing
+        import multiprocessing.connection
+        next_depth = self.get_depth_lower_bound()
+        self.phase_record["lower_bound"] = next_depth
+        max_unsat = next_depth-1
+        min_sat = None
+        results = {}
+        running = {}
+        start_ts = time.time_ns()
+        # the workers still running when the loop ends, also on an error,
+        # are stopped
+        try:
+            while min_sat is None or max_unsat+1 < min_sat:
+                if min_sat is None and self.max_depth is not None and max_unsat >= self.max_depth:
+                    raise Exception("No solution within %d moves" % self.max_depth)
+                while len(running) < self.processes and (min_sat is None or next_depth < min_sat) \
+                        and (self.max_depth is None or next_depth <= self.max_depth):
+                    (receiver, sender) = multiprocessing.Pipe(False)
+                    process = multiprocessing.Process(
+                        target=check_depth, args=(self.copy_for_worker(), next_depth, sender))
+                    process.start()
+                    sender.close()
+                    running[next_depth] = (process, receiver)
+                    next_depth = next_depth+1
+
+                depths = dict((r[1], d) for (d, r) in running.items())
+                for ready in multiprocessing.connection.wait(list(depths.keys())):
+                    depth = depths[ready]
+                    # stopped by a shallower sat depth ready at the same time
+                    if depth not in running:
+                        continue
+                    (process, receiver) = running.pop(depth)
+                    try:
+                        results[depth] = receiver.recv()
+                    except EOFError:
+                        process.join()
+                        raise Exception("Worker for depth %d died" % depth)
+                    finally:
+                        receiver.close()
+                    process.join()
+                    # the depths overlap, so the time is since the portfolio started
+                    self.events.depth({"depth": depth, "result": results[depth][0],
+                                       "seconds": (time.time_ns()-start_ts)/1000000000})
+                    if results[depth][0] == "unknown":
+                        raise Exception("Depth %d could not be decided" % depth)
+                    if results[depth][0] == "sat" and (min_sat is None or depth < min_sat):
+                        min_sat = depth
+                        for d in list(running.keys()):
+                            if d > depth:
+                                (process, receiver) = running.pop(d)
+                                process.terminate()
+                                process.join()
+                                receiver.close()
+                while max_unsat+1 in results and results[max_unsat+1][0] == "unsat":
+                    max_unsat = max_unsat+1
+        finally:
+            for (process, receiver) in running.values():
+                process.terminate()
+                process.join()
+                receiver.close()
+
+        self.model = None
+        self.cube_path = None
+        self.depth = min_sat
+        self.solution = results[min_sat][1]
+        self.value_cube = self.value_cube.apply_move_numbers(self.solution)
+        return self.model
 
-# model = cube_solver.solve_minimum()
+    def solve_minimum(self):
+        start_ts = time.perf_counter()
+        self.phase_record = {"backend": self.backend, "cached": False,
+                             "tabled": False}
+        if self.__solve_minimum_tabled():
+            self.phase_record["tabled"] = True
+        elif self.cache is None or self.macros:
+            self.__solve_minimum()
+        else:
+            self.__solve_minimum_cached()
+        self.phase_record["depth"] = self.depth
+        self.phase_record["moves"] = len(self.solution)
+        self.phase_record["seconds"] = time.perf_counter()-start_ts
+        self.events.phase(self.phase_record)
+        return self.model
 
-# cube_solver.print_moves(0, 3)
-# cube_solver.print_cube()
+    def __solve_minimum_tabled(self):
+        if self.tables is None:
+            return False
+        solution = self.tables.lookup(self.value_cube, self.target_constraints,
+                                      self.restricted, self.move_set)
+        if solution is None:
+            return False
+        self.solution = solution
+        self.value_cube = self.value_cube.apply_move_numbers(solution)
+        self.model = None
+        self.cube_path = None
+        self.depth = len(solution)
+        return True
+
+    def __solve_minimum_cached(self):
+        # one entry per symmetry class, stored as seen from its representative
+        (cube, targets, back) = canonicalize(
+            self.value_cube, self.target_constraints, self.restricted)
+        key = SolutionCache.get_key(
+            cube, targets, self.restricted, self.move_set)
+        cached = self.cache.get(key)
+        if cached is None:
+            model = self.__solve_minimum()
+            self.cache.put(key, back.inverse.apply_moves(self.solution),
+                           back.inverse.apply_cube(self.value_cube))
+            return model
+        self.phase_record["cached"] = True
+        self.solution = back.apply_moves(cached[0])
+        self.value_cube = back.apply_cube(cached[1])
+        self.model = None
+        self.cube_path = None
+        self.depth = len(self.solution)
+        return self.model
 
-# The last two corners
+    def __solve_minimum(self):
+        if self.backend != "sat":
+            return self.__solve_minimum_search()
+        if self.sat_solver != "z3" and (self.optimize_depth is not None or self.incremental
+                                        or self.shared_path is not None):
+            raise Exception("Only z3 can solve incrementally or optimize")
+        if self.optimize_depth is not None:
+            return self.__solve_minimum_optimize()
+        if self.processes > 1:
+            return self.__solve_minimum_parallel()
+        if self.incremental or self.shared_path is not None:
+            return self.__solve_minimum_incremental()
+
+        try_sat = self.get_depth_lower_bound()
+        self.phase_record["lower_bound"] = try_sat
+        while (True):
+            if self.max_depth is not None and try_sat > self.max_depth:
+                raise Exception("No solution within %d moves" % self.max_depth)
+            start_ts = time.perf_counter()
+            self.events.start("encode")
+            cube_path = self.new_path(try_sat)
+            phi = cube_path.get_constraints()
+            self.events.stop("encode")
+            encoded_ts = time.perf_counter()
+            self.events.start("solve")
+            (res, model, statistics) = self.check_constraints(phi)
+            self.events.stop("solve")
+            self.events.depth(get_depth_record(
+                try_sat, res, encoded_ts-start_ts, time.perf_counter()-encoded_ts,
+                statistics))
+            if res != "unsat" and res != "sat":
+                raise Exception("Depth %d could not be decided" % try_sat)
+            if res == "sat":
+                self.model = model
+                self.cube_path = cube_path
+                self.depth = try_sat
+                break
+            try_sat = try_sat+1
 
-# Top face two corners
-cube_solver.add_target_constraint(5, 2, 5)
-cube_solver.add_target_constraint(5, 8, 5)
-cube_solver.add_target_constraint(2, 8, 2)
-cube_solver.add_target_constraint(1, 6, 1)
-cube_solver.add_target_constraint(1, 8, 1)
-cube_solver.add_target_constraint(3, 8, 3)
+        self.solution = self.cube_path.get_move_numbers(self.model)
+        self.value_cube = self.value_cube.apply_move_numbers(self.solution)
 
+        return self.model
 
-model = cube_solver.solve_minimum()
+    def print_cube(self):
+        self.value_cube.print_cube()
 
-cube_solver.print_moves(0, 3)
-cube_solver.print_cube()
+    def print_moves(self, front, left):
+        CubePath.print_move_list(self.solution, front, left)
+
+
+# The phases of the layer by layer solution, grouped by the CubeSolver that
+# solves them: the targets of a phase are added to those of the phases before
+# it in its group, and a restricted phase only turns the side faces.
+PHASE_PLAN = [
+    [("daisy", [(5, 1, 4), (5, 3, 4), (5, 5, 4), (5, 7, 4), (5, 4, 5)], False)],
+    [("bottom cross", [(4, 1, 4), (4, 3, 4), (4, 5, 4), (4, 7, 4),
+                       (0, 1, 0), (1, 1, 1), (2, 3, 2), (3, 3, 3)], False),
+     ("bottom corners 1", [(4, 0, 4), (4, 6, 4), (2, 0, 2),
+                           (0, 0, 0), (0, 2, 0), (3, 0, 3)], False),
+     ("bottom corners 2", [(4, 2, 4), (4, 8, 4), (2, 6, 2),
+                           (3, 6, 3), (1, 0, 1), (1, 2, 1)], False),
+     ("middle layer 1", [(0, 3, 0), (0, 5, 0), (2, 1, 2), (3, 1, 3)], False),
+     ("middle layer 2", [(1, 3, 1), (2, 7, 2)], False),
+     ("middle layer 3", [(1, 5, 1), (3, 7, 3)], False),
+     ("top face cross 1", [(5, 1, 5), (5, 3, 5)], False),
+     ("top face cross 2", [(5, 5, 5), (5, 7, 5)], False),
+     ("top cross sides", [(1, 7, 1), (3, 5, 3), (2, 5, 2), (0, 7, 0)], False),
+     ("top corner", [(5, 0, 5), (2, 2, 2), (0, 6, 0)], True),
+     ("top corners", [(5, 6, 5), (0, 8, 0), (3, 2, 3), (5, 2, 5), (5, 8, 5),
+                      (2, 8, 2), (1, 6, 1), (1, 8, 1), (3, 8, 3)], True)],
+]
+
+
+# The (front, left) faces the moves of a phase are shown from. Once the first
+# two layers are under way, the cube is turned over to show face 5 up.
+PHASE_VIEWS = {
+    "daisy": (0, 2),
+    "bottom cross": (0, 2),
+    "bottom corners 1": (0, 2),
+    "bottom corners 2": (0, 2),
+    "middle layer 1": (0, 3),
+    "middle layer 2": (0, 3),
+    "middle layer 3": (0, 3),
+    "top face cross 1": (0, 3),
+    "top face cross 2": (0, 3),
+    "top cross sides": (0, 3),
+    "top corner": (0, 3),
+    "top corners": (0, 3),
+}
+
+
+# Solves every phase of the plan in turn. configure, if given, is called on
+# each new CubeSolver. solve_phase, if given, is called with the name of each
+# phase and the CubeSolver with its targets to solve it instead of
+# solve_minimum, setting the solution and value_cube of the CubeSolver, and
+# done with the same once the phase is solved. Returns the (phase name, move
+# numbers) of every phase and the final cube.
+def solve_phases(value_cube, configure=None, plan=PHASE_PLAN, solve_phase=None,
+                 done=None):
+    solutions = []
+    for group in plan:
+        cube_solver = CubeSolver(value_cube)
+        if configure is not None:
+            configure(cube_solver)
+        for (name, targets, restricted) in group:
+            if restricted:
+                cube_solver.set_restricted()
+            for c in targets:
+                cube_solver.add_target_constraint(c[0], c[1], c[2])
+            if solve_phase is None:
+                cube_solver.solve_minimum()
+            else:
+                solve_phase(name, cube_solver)
+            solutions.append((name, cube_solver.solution))
+            if done is not None:
+                done(name, cube_solver)
+        value_cube = cube_solver.value_cube
+    return (solutions, value_cube)
+
+
+# Breadth first search from the rows of start, an (N, 54) uint8 array, where a
+# step gathers a row with one of perms (which has to hold the inverse of each
+# of its permutations). Layers are added while there are at most max_states
+# rows. Returns the rows, their distance from start, the row each was reached
+# from (-1 for start) and the index in perms of the step.
+def get_search_ball(start, perms, max_states):
+    import numpy as np
+
+    def get_keys(rows):
+        return np.ascontiguousarray(rows).view(np.dtype((np.void, 54))).ravel()
+    rows = [start]
+    distances = [np.zeros(len(start), dtype=np.int8)]
+    parents = [np.full(len(start), -1, dtype=np.int32)]
+    steps = [np.full(len(start), -1, dtype=np.int8)]
+    # the neighbours of a layer are in the layer before, itself or the next
+    layer_keys = [np.array([], dtype=np.dtype((np.void, 54))), get_keys(start)]
+    layer = start
+    offset = 0
+    total = len(start)
+    while True:
+        candidates = np.concatenate([layer[:, p] for p in perms])
+        (keys, first) = np.unique(get_keys(candidates), return_index=True)
+        new = ~(np.isin(keys, layer_keys[-1]) | np.isin(keys, layer_keys[-2]))
+        first = first[new]
+        if len(first) == 0 or total+len(first) > max_states:
+            break
+        rows.append(candidates[first])
+        distances.append(np.full(len(first), len(distances), dtype=np.int8))
+        parents.append((offset+first % len(layer)).astype(np.int32))
+        steps.append((first//len(layer)).astype(np.int8))
+        layer_keys.append(keys[new])
+        offset = offset+len(layer)
+        layer = rows[-1]
+        total = total+len(layer)
+    return (np.concatenate(rows), np.concatenate(distances),
+            np.concatenate(parents), np.concatenate(steps))
+
+
+# Optimal move sequences for last layer cases by meeting in the middle: a
+# ball of move sequences grown from the identity permutation and one grown
+# backwards from the cubes that satisfy the targets. A case x, turned by every
+# sequence of the first ball at once, meets the second ball in the cubes that
+# are at most its depth from a goal, and the shortest meeting is optimal as
+# long as it is no longer than the depths of the two balls together.
+class LastLayerSearch:
+    def __init__(self, moves, goals, max_states):
+        import numpy as np
+        self.moves = moves
+        identity = np.arange(0, 54, dtype=np.uint8).reshape(1, 54)
+        (self.sequences, self.lengths, self.sequence_parents, self.sequence_steps) = \
+            get_search_ball(identity, [MOVE_PERMUTATIONS[m] for m in moves],
+                            max_states)
+        (cubes, self.distances, self.parents, self.steps) = get_search_ball(
+            np.array([cube.get_stickers() for cube in goals], dtype=np.uint8),
+            [MOVE_PERMUTATIONS[get_inverse_move(m)] for m in moves], max_states)
+        keys = cubes.view(np.dtype((np.void, 54))).ravel()
+        self.order = np.argsort(keys)
+        self.keys = keys[self.order]
+
+    # The move numbers solving value_cube, None if it takes more moves than
+    # the balls reach
+    def solve(self, value_cube):
+        import numpy as np
+        turned = np.array(value_cube.get_stickers(), dtype=np.uint8)[
+            self.sequences]
+        keys = turned.view(np.dtype((np.void, 54))).ravel()
+        found = np.minimum(np.searchsorted(self.keys, keys), len(self.keys)-1)
+        meets = np.nonzero(self.keys[found] == keys)[0]
+        if len(meets) == 0:
+            return None
+        cubes = self.order[found[meets]]
+        best = np.argmin(self.lengths[meets]+self.distances[cubes])
+        moves = []
+        sequence = meets[best]
+        while self.sequence_parents[sequence] >= 0:
+            moves.insert(0, self.moves[self.sequence_steps[sequence]])
+            sequence = self.sequence_parents[sequence]
+        cube = cubes[best]
+        while self.parents[cube] >= 0:
+            moves.append(self.moves[self.steps[cube]])
+            cube = self.parents[cube]
+        return moves
+
+
+# Writes the LastLayerTables of every restricted phase of a plan. The first
+# restricted phase after an unrestricted one is solved from every reachable
+# case, a restricted phase right after another from the cases the solutions
+# of that one lead to. The searches keep at most max_states cubes per ball;
+# the cases they cannot reach within that are left out of the tables.
+def build_last_layer_tables(path, move_set="quarter", max_states=2000000,
+                            plan=PHASE_PLAN):
+    if any(m >= SLICE_TURNS for m in MOVE_SETS[move_set]):
+        raise Exception("The last layer tables need the centres to stay put")
+    moves = [m for m in MOVE_SETS[move_set] if get_move_layer(m) not in [4, 5]]
+    tables = []
+    for group in plan:
+        targets = []
+        cases = None
+        for (name, phase_targets, restricted) in group:
+            targets = targets+phase_targets
+            if not restricted:
+                cases = None
+                continue
+            if cases is None:
+                cases = get_last_layer_cases()
+            goals = [value_cube for value_cube in get_last_layer_cases()
+                     if all(value_cube.get_stickers()[f*9+i] == v for (f, i, v) in targets)]
+            search = LastLayerSearch(moves, goals, max_states)
+            solutions = {}
+            next_cases = {}
+            for value_cube in cases:
+                solution = search.solve(value_cube)
+                if solution is None:
+                    continue
+                solutions[get_last_layer_case(
+                    value_cube.get_stickers())] = solution
+                solved = value_cube.apply_move_numbers(solution)
+                next_cases[get_last_layer_case(solved.get_stickers())] = solved
+            logger.info("%s: %d of %d cases", name, len(solutions), len(cases))
+            tables.append((name, list(targets), solutions))
+            cases = list(next_cases.values())
+
+    record_size = 1+max([len(moves) for (name, targets, solutions) in tables
+                         for moves in solutions.values()]+[0])
+    header = json.dumps({"move_set": move_set, "record_size": record_size,
+                         "tables": [{"phase": name, "targets": targets}
+                                    for (name, targets, solutions) in tables]}).encode()
+    with open(path, "wb") as output:
+        output.write(b"LLT1"+len(header).to_bytes(4, "little")+header)
+        for (name, targets, solutions) in tables:
+            for case in range(0, LAST_LAYER_CASES):
+                if case in solutions:
+                    record = bytes([len(solutions[case])]+solutions[case])
+                else:
+                    record = bytes([255])
+                output.write(record+bytes(record_size-len(record)))
+
+
+# A scramble line is either a move string, applied to a solved cube, or a 54
+# character facelet string (see ValueCube.from_facelets). Moves are read and
+# written as seen with face 0 in front and face 2 on the left.
+def parse_scramble(line):
+    if len(line) == 54 and " " not in line and "," not in line:
+        return ValueCube.from_facelets(line)
+    return ValueCube().apply_move_numbers(CubePath.parse_move_list(line, 0, 2))
+
+
+# Worker of solve_batch: one JSON-ready result per scramble. tables is the
+# path of a LastLayerTables file or None. A scramble with a phase that has no
+# solution within max_depth moves gets an error like an unreadable one.
+def solve_scramble(line, backend, move_set, plan=PHASE_PLAN, tables=None,
+                   max_depth=20):
+    with contextlib.ExitStack() as stack:
+        if tables is not None:
+            tables = LastLayerTables(tables)
+            stack.callback(tables.close)
+
+        def configure(cube_solver):
+            cube_solver.set_backend(backend)
+            cube_solver.set_move_set(move_set)
+            cube_solver.set_tables(tables)
+            cube_solver.set_max_depth(max_depth)
+        start_ts = time.time_ns()
+        try:
+            (solutions, value_cube) = solve_phases(
+                parse_scramble(line), configure, plan)
+        except Exception as e:
+            return {"scramble": line, "error": str(e)}
+    phases = []
+    moves = []
+    for (name, move_numbers) in solutions:
+        relative_moves = CubePath.get_relative_move_list(move_numbers, 0, 2)
+        phases.append({"phase": name, "moves": relative_moves})
+        moves.extend(relative_moves)
+    return {"scramble": line, "moves": moves, "length": len(moves),
+            "phases": phases, "seconds": (time.time_ns()-start_ts)/1000000000}
+
+
+# Solves the scrambles of an iterable of lines on a pool of processes and
+# writes one JSON line per scramble to output as soon as it is solved, even
+# while the next line is still being waited for. At most max_in_flight
+# scrambles are read ahead of the results, so memory does not grow with the
+# input. Empty lines and lines starting with # are skipped.
+def solve_batch(lines, output, processes=None, max_in_flight=None,
+                backend="sat", move_set="quarter", plan=PHASE_PLAN, tables=None,
+                max_depth=20):
+    import concurrent.futures
+    import threading
+    if processes is None:
+        processes = os.cpu_count()
+    if max_in_flight is None:
+        max_in_flight = 2*processes
+    slots = threading.Semaphore(max_in_flight)
+    lock = threading.Lock()
+    errors = []
+
+    # called by the executor as soon as a scramble is solved, the first error
+    # is raised by the reading loop
+    def write(future):
+        with lock:
+            if future.exception() is not None:
+                errors.append(future.exception())
+            else:
+                output.write(json.dumps(future.result())+"\n")
+                output.flush()
+        slots.release()
+
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        for line in lines:
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            slots.acquire()
+            if len(errors) > 0:
+                break
+            executor.submit(solve_scramble, line, backend, move_set, plan,
+                            tables, max_depth).add_done_callback(write)
+    if len(errors) > 0:
+        raise errors[0]
+
+
+# python solve.py batch [input] [-o output] [--processes N] ...
+def batch_main(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog="solve.py batch",
+                                     description="Solve a stream of scrambles, one per line.")
+    parser.add_argument("input", nargs="?", default="-",
+                        help="file of scrambles, - for stdin")
+    parser.add_argument("-o", "--output", default="-",
+                        help="JSONL file of results, - for stdout")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--in-flight", type=int, default=None)
+    parser.add_argument("--backend", default="sat",
+                        choices=["sat", "ida", "mitm"])
+    parser.add_argument("--move-set", default="quarter",
+                        choices=sorted(MOVE_SETS))
+    parser.add_argument("--tables", default=None,
+                        help="last layer table file (see the tables command)")
+    parser.add_argument("--max-depth", type=int, default=20,
+                        help="give up on a phase deeper than this")
+    options = parser.parse_args(args)
+    with contextlib.ExitStack() as stack:
+        lines = sys.stdin
+        if options.input != "-":
+            lines = stack.enter_context(open(options.input))
+        output = sys.stdout
+        if options.output != "-":
+            output = stack.enter_context(open(options.output, "w"))
+        solve_batch(lines, output, options.processes, options.in_flight,
+                    options.backend, options.move_set, tables=options.tables,
+                    max_depth=options.max_depth)
+
+
+# count scrambles of length random quarter turns, the same for the same seed
+def make_corpus(seed, count, length):
+    generator = random.Random(seed)
+    corpus = []
+    for i in range(0, count):
+        moves = [generator.randrange(0, 12) for j in range(0, length)]
+        corpus.append(" ".join(CubePath.get_relative_move_list(moves, 0, 2)))
+    return corpus
+
+
+# The first `phases` phases of a plan
+def truncate_plan(plan, phases):
+    truncated = []
+    for group in plan:
+        if phases <= 0:
+            break
+        truncated.append(group[:phases])
+        phases = phases-len(group)
+    return truncated
+
+
+# Solves the phases of the plan with a fresh CubeSolver.new_path and Solver
+# per depth, like the plain solve_minimum loop, and records for every depth
+# the result, the seconds spent building the encoding and solving it, the z3
+# statistics and, if sizes is set, the size of the CNF. The depths start at
+# the lower bound of the phase, recorded with it, or at 0 if lower_bound is
+# not set.
+def benchmark_phases(value_cube, configure=None, plan=PHASE_PLAN, sizes=True,
+                     lower_bound=True):
+    records = []
+
+    def solve_phase(name, cube_solver):
+        depths = []
+        start_ts = time.perf_counter()
+        depth = cube_solver.get_depth_lower_bound() if lower_bound else 0
+        bound_seconds = time.perf_counter()-start_ts
+        while True:
+            start_ts = time.perf_counter()
+            cube_path = cube_solver.new_path(depth)
+            phi = cube_path.get_constraints()
+            encoded_ts = time.perf_counter()
+            solver = z3.Solver()
+            solver.add(phi)
+            res = solver.check()
+            solved_ts = time.perf_counter()
+            record = {"depth": depth, "result": str(res),
+                      "encode_seconds": encoded_ts-start_ts,
+                      "solve_seconds": solved_ts-encoded_ts,
+                      "statistics": get_statistics(solver)}
+            if sizes:
+                (record["variables"], record["clauses"]) = cnf_size(phi)
+            depths.append(record)
+            if res == z3.sat:
+                break
+            if res != z3.unsat:
+                raise Exception("Depth %d could not be decided" % depth)
+            depth = depth+1
+        cube_solver.solution = cube_path.get_move_numbers(solver.model())
+        cube_solver.value_cube = cube_solver.value_cube.apply_move_numbers(
+            cube_solver.solution)
+        records.append({"phase": name, "depth": depth, "depths": depths,
+                        "lower_bound": depths[0]["depth"],
+                        "seconds": bound_seconds+sum(r["encode_seconds"]+r["solve_seconds"]
+                                                     for r in depths)})
+
+    solve_phases(value_cube, configure, plan, solve_phase)
+    return records
+
+
+# python solve.py bench [-o results.json] [--seed S] [--count N] ...
+def bench_main(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog="solve.py bench",
+                                     description="Time the SAT phases on a seeded scramble corpus.")
+    parser.add_argument("-o", "--output", default="-")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--count", type=int, default=3)
+    parser.add_argument("--length", type=int, default=20)
+    parser.add_argument("--phases", type=int, default=3,
+                        help="how many phases of the plan to solve")
+    parser.add_argument("--no-sizes", action="store_true",
+                        help="do not count the variables and clauses")
+    parser.add_argument("--move-set", default="quarter",
+                        choices=sorted(MOVE_SETS))
+    parser.add_argument("--move-encoding", default="onehot",
+                        choices=sorted(MOVE_ENCODINGS))
+    parser.add_argument("--transition-encoding", default="implication",
+                        choices=["implication", "functional"])
+    parser.add_argument("--state-encoding", default="sticker",
+                        choices=["sticker", "cubie"])
+    parser.add_argument("--pruning-level", type=int, default=1,
+                        choices=[0, 1, 2, 3])
+    parser.add_argument("--no-lower-bound", action="store_true",
+                        help="start every phase at depth 0")
+    options = parser.parse_args(args)
+
+    def configure(cube_solver):
+        cube_solver.set_move_set(options.move_set)
+        cube_solver.set_move_encoding(options.move_encoding)
+        cube_solver.set_transition_encoding(options.transition_encoding)
+        cube_solver.set_state_encoding(options.state_encoding)
+        cube_solver.set_pruning_level(options.pruning_level)
+
+    plan = truncate_plan(PHASE_PLAN, options.phases)
+    results = {"corpus": {"seed": options.seed, "count": options.count,
+                          "length": options.length},
+               "phases": options.phases,
+               "settings": {"move_set": options.move_set,
+                            "move_encoding": options.move_encoding,
+                            "transition_encoding": options.transition_encoding,
+                            "state_encoding": options.state_encoding,
+                            "pruning_level": options.pruning_level,
+                            "lower_bound": not options.no_lower_bound},
+               "z3": z3.get_version_string(),
+               "scrambles": []}
+    for scramble in make_corpus(options.seed, options.count, options.length):
+        records = benchmark_phases(parse_scramble(scramble), configure, plan,
+                                   not options.no_sizes, not options.no_lower_bound)
+        results["scrambles"].append({"scramble": scramble, "phases": records,
+                                     "seconds": sum(r["seconds"] for r in records)})
+        print("%s: %.3f" % (scramble, results["scrambles"][-1]["seconds"]),
+              file=sys.stderr)
+    text = json.dumps(results, indent=1)
+    if options.output == "-":
+        print(text)
+    else:
+        with open(options.output, "w") as output:
+            output.write(text)
+
+
+# The regressions of new against old, two results of bench_main on the same
+# corpus: a phase whose optimal depth changed, a phase that got slower by
+# more than threshold (as a fraction) and min_seconds, or a depth whose CNF
+# got bigger.
+def compare_benchmarks(old, new, threshold=0.2, min_seconds=0.05):
+    regressions = []
+    if old["corpus"] != new["corpus"] or old["phases"] != new["phases"]:
+        regressions.append("the runs are on different corpora")
+        return regressions
+    for (old_scramble, new_scramble) in zip(old["scrambles"], new["scrambles"]):
+        scramble = new_scramble["scramble"]
+        for (old_phase, new_phase) in zip(old_scramble["phases"], new_scramble["phases"]):
+            phase = new_phase["phase"]
+            if old_phase["depth"] != new_phase["depth"]:
+                regressions.append("%s, %s: depth %d -> %d" % (
+                    scramble, phase, old_phase["depth"], new_phase["depth"]))
+                continue
+            if new_phase["seconds"] > old_phase["seconds"]*(1+threshold) and \
+                    new_phase["seconds"]-old_phase["seconds"] > min_seconds:
+                regressions.append("%s, %s: %.3fs -> %.3fs" % (
+                    scramble, phase, old_phase["seconds"], new_phase["seconds"]))
+            # the deepest depth the CNF grew at, once per phase
+            grown = None
+            # the runs can start a phase at different lower bounds
+            old_depths = dict((d["depth"], d) for d in old_phase["depths"])
+            for new_depth in new_phase["depths"]:
+                old_depth = old_depths.get(new_depth["depth"], {})
+                if new_depth.get("clauses", 0) > old_depth.get("clauses", 0) > 0:
+                    grown = (new_depth["depth"], old_depth["clauses"],
+                             new_depth["clauses"])
+            if grown is not None:
+                regressions.append("%s, %s: %d -> %d clauses at depth %d" % (
+                    scramble, phase, grown[1], grown[2], grown[0]))
+    return regressions
+
+
+# python solve.py compare old.json new.json [--threshold T]
+def compare_main(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog="solve.py compare",
+                                     description="Flag the regressions between two bench runs.")
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--min-seconds", type=float, default=0.05)
+    options = parser.parse_args(args)
+    with open(options.old) as old_file, open(options.new) as new_file:
+        old = json.load(old_file)
+        new = json.load(new_file)
+    if old["settings"] != new["settings"]:
+        print("settings: %s -> %s" % (old["settings"], new["settings"]))
+    old_seconds = sum(s["seconds"] for s in old["scrambles"])
+    new_seconds = sum(s["seconds"] for s in new["scrambles"])
+    print("total: %.3fs -> %.3fs" % (old_seconds, new_seconds))
+    regressions = compare_benchmarks(
+        old, new, options.threshold, options.min_seconds)
+    for regression in regressions:
+        print("REGRESSION "+regression)
+    return 1 if len(regressions) > 0 else 0
+
+
+# Scrambles a cube with 20 random quarter turns and solves it phase by phase,
+# printing the moves and the cube after every phase. configure, if given, is
+# called on every CubeSolver.
+def demo(seed=None, configure=None):
+    generator = random.Random(seed)
+    start_cube = ValueCube()
+    for i in range(0, 20):
+        face = generator.randrange(0, 6)
+        dir = generator.randrange(0, 2)
+        if i % 5 == 0:
+            print("")
+            start_cube.print_cube()
+        print(CubePath.get_relative_move(face, dir, 0, 2), end=",")
+
+        start_cube = start_cube.rotate_face(face, dir)
+
+    print("")
+    print("Starting solution")
+
+    start_cube.print_cube()
+
+    def done(name, cube_solver):
+        print(name)
+        (front, left) = PHASE_VIEWS.get(name, (0, 2))
+        cube_solver.print_moves(front, left)
+        cube_solver.print_cube()
+    solve_phases(start_cube, configure, PHASE_PLAN, done=done)
+
+
+# python solve.py demo [--seed S] [--backend ...] [--move-set ...] [--sat-solver ...]
+# [--tables path] [--macros]
+def demo_main(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog="solve.py demo",
+                                     description="Solve a random scramble phase by phase.")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--backend", default="sat",
+                        choices=["sat", "ida", "mitm"])
+    parser.add_argument("--move-set", default="quarter",
+                        choices=sorted(MOVE_SETS))
+    parser.add_argument("--sat-solver", default="z3",
+                        choices=["z3"]+sorted(SAT_SOLVERS))
+    parser.add_argument("--tables", default=None,
+                        help="last layer table file (see the tables command)")
+    parser.add_argument("--macros", action="store_true",
+                        help="let the sat backend use the MACROS sequences as single moves")
+    options = parser.parse_args(args)
+    tables = None
+    if options.tables is not None:
+        tables = LastLayerTables(options.tables)
+
+    def configure(cube_solver):
+        cube_solver.set_backend(options.backend)
+        cube_solver.set_move_set(options.move_set)
+        cube_solver.set_sat_solver(options.sat_solver)
+        cube_solver.set_tables(tables)
+        if options.macros:
+            cube_solver.set_macros()
+    demo(options.seed, configure)
+
+
+# python solve.py tables [-o path] [--move-set ...] [--max-states N]
+def tables_main(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog="solve.py tables",
+                                     description="Build the last layer tables of the restricted phases.")
+    parser.add_argument("-o", "--output", default="last_layer.llt")
+    parser.add_argument("--move-set", default="quarter",
+                        choices=sorted(MOVE_SETS))
+    parser.add_argument("--max-states", type=int, default=2000000,
+                        help="cubes kept per search ball; more reaches deeper cases")
+    options = parser.parse_args(args)
+    build_last_layer_tables(options.output, options.move_set,
+                            options.max_states)
+
+
+COMMANDS = {"demo": demo_main, "batch": batch_main, "bench": bench_main,
+            "compare": compare_main, "tables": tables_main}
+
+
+# python solve.py [command] [options], the command being one of COMMANDS
+# (demo if there is none)
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    command = "demo"
+    if len(argv) > 0 and not argv[0].startswith("-"):
+        command = argv[0]
+        argv = argv[1:]
+    if command not in COMMANDS:
+        print("usage: solve.py [%s] [options]" % "|".join(COMMANDS),
+              file=sys.stderr)
+        return 2
+    status = COMMANDS[command](argv)
+    return status if status is not None else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())